@@ -0,0 +1,62 @@
+import argparse
+import os
+import random
+import tempfile
+import textwrap as twp
+import time
+
+from telegramBotExcel import PDF_RENDERERS
+
+# Compares the PDF backends on synthetic cinema pages shaped like the ones in the report
+
+
+def synthetic_pages(n_cinemas, n_films):
+    random.seed(0)
+    pages = []
+    for c in range(n_cinemas):
+        rows = []
+        for f in range(n_films):
+            incassi = round(random.uniform(50, 5000), 2)
+            presenze = random.randint(5, 500)
+            rows.append([twp.fill(f"Film Di Prova Numero {f} Con Un Titolo Abbastanza Lungo", 40), incassi, presenze, round(incassi / presenze, 2)])
+        rows.sort(key=lambda x: (-x[2]))
+        incassi_totali = round(sum(row[1] for row in rows), 2)
+        presenze_totali = sum(row[2] for row in rows)
+        rows.append(['Totale', incassi_totali, presenze_totali, round(incassi_totali / presenze_totali, 2)])
+        pages.append((f"Cinema {c} (Roma) - Incassi settimanali", rows))
+    return pages
+
+
+def run(renderer_name, pages, output_dir):
+    full_name = os.path.join(output_dir, f"benchmark_{renderer_name}.pdf")
+    start = time.perf_counter()
+
+    pdf = PDF_RENDERERS[renderer_name](full_name)
+    for title, rows in pages:
+        pdf.add_table_page(title, ['Film', 'Incassi', 'Presenze', 'Prezzo medio'], rows, 5, (1.2, 1.25), bold_last_row=True)
+    pdf.close()
+
+    return time.perf_counter() - start, os.path.getsize(full_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the PDF report backends on synthetic data")
+    parser.add_argument("--cinemas", type=int, default=10)
+    parser.add_argument("--films", type=int, default=20)
+    parser.add_argument("--renderers", nargs="+", default=list(PDF_RENDERERS))
+    args = parser.parse_args()
+
+    pages = synthetic_pages(args.cinemas, args.films)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for renderer_name in args.renderers:
+            try:
+                elapsed, size = run(renderer_name, pages, output_dir)
+            except Exception as e:
+                print(f"{renderer_name:>8}: failed ({e!r})")
+                continue
+            print(f"{renderer_name:>8}: {elapsed:.3f}s for {len(pages)} pages ({elapsed / len(pages) * 1000:.1f} ms/page, {size / 1024:.0f} KiB)")
+
+
+if __name__ == '__main__':
+    main()
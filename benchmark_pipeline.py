@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import openpyxl
+
+try:
+    import resource
+except ImportError:
+    # Windows has no resource module, the run is then reported without its memory
+    resource = None
+
+# Times every stage of /analizza on synthetic box-office exports, from parsing the uploads to
+# rendering the reports, then runs the whole bot flow offline with stubbed Telegram objects.
+# The bot keeps its history, cache and workspaces in a scratch directory for the run
+bench_dir = tempfile.mkdtemp(prefix="benchmark_")
+for name in ["HISTORY_DB", "CACHE_DIR", "WORKSPACES_DIR"]:
+    os.environ[name] = os.path.join(bench_dir, name.lower())
+
+import telegramBotExcel as bot_module
+
+WEEK_DAYS = ['Giovedì', 'Venerdì', 'Sabato', 'Domenica', 'Lunedì', 'Martedì', 'Mercoledì']
+
+
+def synthetic_cinemas(n_cinemas):
+    # The tracked competitors first, then untracked cinemas the report has to filter out
+    cinemas = bot_module.competitors.keys[:n_cinemas]
+    for i in range(n_cinemas - len(cinemas)):
+        cinemas.append((f"Città {i % 20}", f"Cinema Di Prova {i}"))
+    return cinemas
+
+
+def synthetic_workbook(n_rows, cinemas, n_days=7, seed=0):
+    # Same layout as the exports: two title rows, the header, the data and two footer rows
+    random.seed(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+
+    days = [WEEK_DAYS[i % len(WEEK_DAYS)] for i in range(n_days)]
+    sheet.append(["Borderò settimanale per cinema e film"])
+    sheet.append([f"Esportato il {time.strftime('%d/%m/%Y')}"])
+    sheet.append(["Città", "Cinema", "Titolo Film", "Distributore"] + [f"{kind} {day}" for day in days for kind in ["Incassi", "Presenze"]])
+
+    for i in range(n_rows):
+        city, cinema = cinemas[i % len(cinemas)]
+        # Exports are not consistent with the case of the names
+        if random.random() < 0.2:
+            city, cinema = city.upper(), cinema.upper()
+
+        row = [city, cinema, f"film di prova {random.randrange(max(n_rows // len(cinemas), 1))}", "Distribuzione"]
+        for _ in days:
+            presenze = random.randint(0, 300)
+            row += [round(presenze * random.uniform(6, 11), 2), presenze]
+        sheet.append(row)
+
+    sheet.append([None])
+    sheet.append(["Totale", None, None, None] + [0] * (2 * n_days))
+
+    file_out = io.BytesIO()
+    workbook.save(file_out)
+    return file_out.getvalue()
+
+
+def peak_rss_mb():
+    # Peaks of the whole run, ru_maxrss is in KiB on Linux and the pools' workers only count as
+    # children once they have exited
+    if resource is None:
+        return None, None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+
+def report(stage, elapsed, n_rows=None, n_bytes=None):
+    own, children = peak_rss_mb()
+    line = f"{stage:>12}: {elapsed:8.3f}s"
+    if n_rows:
+        line += f" {n_rows / elapsed:12,.0f} rows/s"
+    if n_bytes:
+        line += f" {n_bytes / elapsed / 1024 / 1024:8.1f} MB/s"
+    if own is not None:
+        line = f"{line:<60} peak RSS {own:7.1f} MB (workers {children:7.1f} MB)"
+    print(line)
+
+
+def run_stages(files, output_dir):
+    n_bytes = sum(len(data) for data in files)
+
+    start = time.perf_counter()
+    buffers = [bot_module.parse_box_office_file(data)[0] for data in files]
+    n_rows = sum(buffer.n_rows for buffer in buffers)
+    report("ingest", time.perf_counter() - start, n_rows, n_bytes)
+
+    start = time.perf_counter()
+    buffer = bot_module.ColumnBuffer()
+    for parsed in buffers:
+        buffer.extend(parsed)
+    report("merge", time.perf_counter() - start, n_rows)
+
+    start = time.perf_counter()
+    model = bot_module.build_report_model(buffer, bot_module.last_cinema_week(datetime.now()), bot_module.competitors)
+    report("aggregate", time.perf_counter() - start, n_rows)
+
+    start = time.perf_counter()
+    pages = bot_module.build_pdf_pages(model)
+    bot_module.render_pdf_pages(pages, os.path.join(output_dir, "benchmark.pdf"))
+    elapsed = time.perf_counter() - start
+    report("render pdf", elapsed)
+    print(f"{'':>12}  {len(pages)} pages, {elapsed / max(len(pages), 1) * 1000:.1f} ms/page")
+
+    start = time.perf_counter()
+    bot_module.render_excel_report(model, os.path.join(output_dir, "benchmark.xlsx"))
+    report("render xlsx", time.perf_counter() - start)
+
+
+class StubDocument:
+    def __init__(self, file_name, data):
+        self.file_name = file_name
+        self.data = data
+
+
+class StubFile:
+    def __init__(self, data):
+        self.data = data
+
+    async def download_to_memory(self, out):
+        out.write(self.data)
+
+
+class StubMessage:
+    def __init__(self, chat_id, document=None):
+        self.chat_id = chat_id
+        self.document = document
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class StubUpdate:
+    def __init__(self, chat_id, document=None):
+        self.message = StubMessage(chat_id, document)
+
+
+class StubSentMessage:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class StubBot:
+    # Records what the bot would have sent instead of calling Telegram
+    def __init__(self):
+        self.messages = []
+        self.edits = []
+        self.documents = []
+
+    async def get_file(self, document):
+        return StubFile(document.data)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+        return StubSentMessage(len(self.messages))
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edits.append((chat_id, message_id, text))
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        data = document.read() if hasattr(document, "read") else document
+        if hasattr(document, "close"):
+            document.close()
+        self.documents.append((chat_id, filename, len(data)))
+
+
+class StubContext:
+    def __init__(self, bot, args=None):
+        self.bot = bot
+        self.args = args or []
+
+
+class StubApplication:
+    def __init__(self, bot):
+        self.bot = bot
+
+
+async def run_bot(files, formats, chat_id=1):
+    # The same path a chat goes through: upload every file, ask for the report, wait for the worker
+    bot = StubBot()
+
+    start = time.perf_counter()
+    for i, data in enumerate(files):
+        update = StubUpdate(chat_id, StubDocument(f"export_{i}.xlsx", data))
+        await bot_module.handle_files(update, StubContext(bot))
+
+    update = StubUpdate(chat_id)
+    await bot_module.process_xlsx(update, StubContext(bot, formats))
+
+    worker = asyncio.create_task(bot_module.report_worker(StubApplication(bot)))
+    await bot_module.job_queue.join()
+    worker.cancel()
+    elapsed = time.perf_counter() - start
+
+    report("bot", elapsed)
+    for _, filename, size in bot.documents:
+        print(f"{'':>12}  sent {filename} ({size / 1024:.0f} KiB)")
+    for _, text in bot.messages:
+        print(f"{'':>12}  message: {text.splitlines()[0]}")
+    print(f"{'':>12}  {len(bot.edits)} progress edits")
+
+    if len(bot.documents) != len(formats):
+        raise RuntimeError(f"Expected {len(formats)} reports, the bot sent {len(bot.documents)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the report pipeline on synthetic box-office exports")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=5000, help="data rows per file")
+    parser.add_argument("--cinemas", type=int, default=50)
+    parser.add_argument("--days", type=int, default=7, help="Incassi/Presenze column pairs per file")
+    parser.add_argument("--formats", nargs="+", default=["pdf", "xlsx"], choices=bot_module.REPORT_FORMATS)
+    parser.add_argument("--skip-bot", action="store_true", help="only time the stages in this process")
+    args = parser.parse_args()
+
+    try:
+        cinemas = synthetic_cinemas(args.cinemas)
+        start = time.perf_counter()
+        files = [synthetic_workbook(args.rows, cinemas, args.days, seed=i) for i in range(args.files)]
+        print(f"Generated {args.files} files x {args.rows} rows, {len(cinemas)} cinemas, "
+              f"{sum(len(data) for data in files) / 1024 / 1024:.1f} MB in {time.perf_counter() - start:.1f}s")
+
+        output_dir = os.path.join(bench_dir, "reports")
+        os.makedirs(output_dir)
+        run_stages(files, output_dir)
+
+        if not args.skip_bot:
+            asyncio.run(run_bot(files, args.formats))
+    finally:
+        for pool in [bot_module.parse_pool, bot_module.render_pool]:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        own, children = peak_rss_mb()
+        if own is not None:
+            print(f"Peak RSS: {own:.1f} MB in the bot process, {children:.1f} MB in the largest worker")
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import os
+import sys
+import time
+
+# Checks /mario offline against a local stub of the joke API: served from the prefetched jokes,
+# answering on time when the API hangs and when it fails
+os.environ["HTTP_TIMEOUT"] = "0.5"
+
+import httpx
+
+import telegramBotExcel as bot_module
+
+
+class StubJokeServer:
+    # /joke answers, /slow never answers in time, /error fails. Connections are kept alive like a real API
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+                    pass
+
+                self.requests += 1
+                path = request_line.split()[1].decode()
+                if path == "/slow":
+                    await asyncio.sleep(5)
+
+                status = "500 Internal Server Error" if path == "/error" else "200 OK"
+                body = json.dumps({"setup": f"Battuta {self.requests}", "punchline": "Finale"}).encode()
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+class StubMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class StubUpdate:
+    def __init__(self):
+        self.message = StubMessage()
+
+
+def check(name, condition, detail=""):
+    print(f"{name:>10}: {'ok' if condition else 'FAILED'} {detail}")
+    return condition
+
+
+async def run_checks():
+    server = StubJokeServer()
+    base_url = await server.start()
+    results = []
+
+    try:
+        # A prefetched cache answers without going to the API
+        jokes = bot_module.JokeCache(f"{base_url}/joke", 3, 60)
+        await jokes.prefetch()
+        n_requests = server.requests
+        joke = await jokes.get()
+        results.append(check("prefetch", len(jokes.jokes) == 2 and server.requests == n_requests and joke.startswith("Battuta"),
+                             f"({n_requests} jokes fetched, {server.connections} connections)"))
+        await jokes.prefetch()
+
+        # Expired jokes are dropped and a fresh one is fetched
+        jokes.ttl = 0
+        time.sleep(0.01)
+        n_requests = server.requests
+        await jokes.get()
+        results.append(check("ttl", server.requests > n_requests))
+        await jokes.prefetch()
+
+        # A hanging API costs the timeout and nothing more, and the event loop keeps running
+        jokes = bot_module.JokeCache(f"{base_url}/slow", 1, 60)
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.05)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        start = time.perf_counter()
+        try:
+            await jokes.get()
+            timed_out = False
+        except httpx.TimeoutException:
+            timed_out = True
+        elapsed = time.perf_counter() - start
+        ticker.cancel()
+        results.append(check("timeout", timed_out and elapsed < 1.5 and ticks >= 5, f"({elapsed:.2f}s, loop ticked {ticks} times)"))
+
+        # A failing API gets the fallback reply from /mario
+        bot_module.jokes = bot_module.JokeCache(f"{base_url}/error", 1, 60)
+        update = StubUpdate()
+        await bot_module.send_joke(update, None)
+        results.append(check("error", update.message.replies == ["No joke for you."], f"({update.message.replies})"))
+        if bot_module.jokes.refill_task is not None:
+            await bot_module.jokes.refill_task
+    finally:
+        await bot_module.close_http_client(None)
+        server.close()
+
+    return all(results)
+
+
+def main():
+    sys.exit(0 if asyncio.run(run_checks()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import io
+import random
+import sys
+
+import openpyxl
+import pandas as pd
+
+import telegramBotExcel as bot_module
+
+# Checks that every reader of the bot finds the same incassi and presenze totals as the original
+# pd.read_excel path, on an export whose header repeats Incassi and Presenze under a row of days,
+# and that only rows repeated in full are counted once
+
+DAYS = ['Giovedì', 'Venerdì', 'Sabato']
+
+
+def fixture_workbook(n_rows=200, seed=0):
+    random.seed(seed)
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+
+    sheet.append(["Borderò settimanale per cinema e film"])
+    sheet.append([None, None, None] + [day for day in DAYS for _ in range(2)])
+    sheet.append(["Città", "Cinema", "Titolo Film"] + ["Incassi", "Presenze"] * len(DAYS))
+
+    cinemas = [("ROMA", "TROISI"), ("Roma", "Barberini"), ("Milano", "BELTRADE"), ("Trento", "Roma")]
+    for i in range(n_rows):
+        city, cinema = cinemas[i % len(cinemas)]
+        row = [city, cinema, f"Film {i % 7}"]
+        for _ in DAYS:
+            presenze = random.randint(0, 100)
+            row += [round(presenze * random.uniform(6, 11), 2), presenze]
+        sheet.append(row)
+
+    sheet.append(["Totale", None, None] + [0] * (2 * len(DAYS)))
+    sheet.append(["Generato automaticamente"])
+
+    file_out = io.BytesIO()
+    workbook.save(file_out)
+    return file_out.getvalue()
+
+
+def totals(df):
+    # A repeated label selects all its columns at once with read_excel, so each label is listed once
+    columns_incasso = list(dict.fromkeys(col for col in df.columns if "Incass" in col.split()[0]))
+    columns_presenze = list(dict.fromkeys(col for col in df.columns if "Presenz" in col))
+    keys = [df["Città"].astype(str).str.title(), df["Cinema"].astype(str).str.title()]
+    return pd.DataFrame({
+        "Incassi": df[columns_incasso].apply(pd.to_numeric).sum(axis=1),
+        "Presenze": df[columns_presenze].apply(pd.to_numeric).sum(axis=1),
+    }).groupby(keys).sum()
+
+
+def read_excel_totals(data):
+    # The parsing of the original bot: the third row holds the labels, two footer rows at the bottom
+    df = pd.read_excel(io.BytesIO(data))
+    df.columns = list(df.iloc[1])
+    df = df[2:-2].reset_index(drop=True)
+    return totals(df)
+
+
+def screenings_workbook(rows):
+    # An export with the Sala column, which the report itself does not keep
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["Città", "Cinema", "Sala", "Titolo Film", "Incassi", "Presenze"])
+    for row in rows:
+        sheet.append(row)
+    file_out = io.BytesIO()
+    workbook.save(file_out)
+    return file_out.getvalue()
+
+
+def check_duplicates():
+    # Dune in two rooms with the same numbers is two screenings, the second file repeats the first
+    screenings = [["Roma", "Troisi", "Sala 1", "Dune", 10, 2], ["Roma", "Troisi", "Sala 2", "Dune", 10, 2]]
+    files = [screenings_workbook(screenings), screenings_workbook(screenings[:1] + [["ROMA", "TROISI", "Sala 1", "dune", 10.0, 2]])]
+
+    buffer = bot_module.ColumnBuffer()
+    for data in files:
+        bot_module.read_box_office_file(io.BytesIO(data), buffer)
+    df = buffer.to_frame().drop_duplicates(subset=[bot_module.ROW_FINGERPRINT])
+
+    found = (df["Incassi"].sum(), df["Presenze"].sum())
+    if found == (20, 4):
+        print(f"{'repeated':>8}: ok, {len(df)} of {buffer.n_rows} rows kept")
+        return True
+    print(f"{'repeated':>8}: expected 20 incassi and 4 presenze, found {found[0]} and {found[1]}")
+    return False
+
+
+def main():
+    data = fixture_workbook()
+    expected = read_excel_totals(data)
+
+    readers = {
+        "openpyxl": lambda buffer: bot_module.read_box_office_file(io.BytesIO(data), buffer),
+        "repair": lambda buffer: bot_module.read_box_office_file(io.BytesIO(bot_module.repair_workbook(data)), buffer),
+        "lenient": lambda buffer: bot_module.read_box_office_xml(data, buffer),
+    }
+
+    failed = False
+    for name, read in readers.items():
+        buffer = bot_module.ColumnBuffer()
+        read(buffer)
+        found = totals(buffer.to_frame())
+
+        if found.index.equals(expected.index) and ((found - expected).abs() < 1e-6).all().all():
+            print(f"{name:>8}: ok, {buffer.n_rows} rows")
+        else:
+            print(f"{name:>8}: totals differ from read_excel\n{pd.concat([expected, found], axis=1, keys=['read_excel', name])}")
+            failed = True
+
+    if not check_duplicates():
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
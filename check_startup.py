@@ -0,0 +1,64 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# Fails when importing the bot gets slower than the budget or pulls in the analysis stack,
+# which the bot only loads in its workers and on the first report
+
+HEAVY_MODULES = ["pandas", "numpy", "openpyxl", "matplotlib", "reportlab", "pypdf", "pyarrow"]
+
+PROBE = f"""
+import sys
+import telegramBotExcel
+print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))
+"""
+
+
+def measure():
+    # A fresh interpreter per run, with -X importtime reporting the cumulative microseconds of every import
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        # Nested imports keep their indentation
+        imports.append((int(cumulative_us), name[1:]))
+
+    total = dict((name, cumulative_us) for cumulative_us, name in imports)["telegramBotExcel"] / 1e6
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return total, loaded, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the time it takes to import the bot")
+    parser.add_argument("--budget", type=float, default=float(os.environ.get("STARTUP_BUDGET", 0.5)), help="seconds")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports of the bot to show")
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    total, loaded, imports = min(runs, key=lambda run: run[0])
+
+    # The bot's own imports are indented by one level in the importtime tree
+    top_level = sorted([(us, name.strip()) for us, name in imports if name.startswith("  ") and not name.startswith("   ")], reverse=True)
+    print(f"Importing the bot takes {total:.3f}s (best of {args.runs}, budget {args.budget:.3f}s)")
+    for cumulative_us, name in top_level[:args.top]:
+        print(f"{cumulative_us / 1e6:8.3f}s  {name}")
+
+    failed = False
+    if total > args.budget:
+        print(f"Over budget by {total - args.budget:.3f}s")
+        failed = True
+    if len(loaded) > 0:
+        print(f"Heavy modules imported at startup: {', '.join(loaded)}")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,32 @@
-import pandas as pd
 import os
 import time
-import pyautogui
+import asyncio
+import hashlib
+import sqlite3
+import importlib
+import importlib.util
+import io
+import contextlib
+import re
+import zipfile
+from xml.etree import ElementTree
+import functools
+import shutil
+import tempfile
+import itertools
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import html
 import json
-from datetime import datetime
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+from datetime import datetime, timedelta
 import textwrap as twp
-from tg_tqdm import tg_tqdm
-import copy
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
 from pathlib import Path
-import requests
+import httpx
 import logging
 import traceback
 
@@ -28,366 +40,1392 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
-# Set LaTeX rendering for matplotlib
-plt.rcParams['text.usetex'] = True
-pd.set_option('future.no_silent_downcasting', True)
+class LazyModule:
+    # Stands in for a heavy module and imports it on first use, so the bot starts answering
+    # commands without loading the analysis and rendering stack. setup runs once after the import.
+    # The proxy's own attributes are private so they never hide the ones of the module
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._setup is not None:
+                self._setup(module)
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+pd = LazyModule("pandas", setup=lambda pd: pd.set_option('future.no_silent_downcasting', True))
+np = LazyModule("numpy")
+openpyxl = LazyModule("openpyxl")
+plt = LazyModule("matplotlib.pyplot")
+backend_pdf = LazyModule("matplotlib.backends.backend_pdf")
+pdf_canvas = LazyModule("reportlab.pdfgen.canvas")
+pdfmetrics = LazyModule("reportlab.pdfbase.pdfmetrics")
+pypdf = LazyModule("pypdf")
+
+# reportlab and pypdf are optional, the report falls back on the LaTeX renderer and on a single PDF worker
+HAS_REPORTLAB = importlib.util.find_spec("reportlab") is not None
+HAS_PYPDF = importlib.util.find_spec("pypdf") is not None
 
 # Mapping alphabet characters to indices
 alphabet_to_index = {chr(i): i - ord('A') for i in range(ord('A'), ord('Z') + 1)}
 
-def filter_cinema(df, cinema_name):
-    return df[df["Cinema"].str.fullmatch(cinema_name)]
-
-def clean_file(file_in):
-    os.startfile(file_in, 'edit')
-    time.sleep(5)
-    pyautogui.hotkey('ctrl', 's')
-    pyautogui.hotkey('alt', 'f4')
+# Stylesheet swapped in for the broken ones produced by the box-office system
+MINIMAL_STYLESHEET = b'''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>'''
+
+# PDF backend: "direct" draws the tables with reportlab, "latex" renders matplotlib figures through LaTeX
+PDF_RENDERER = os.environ.get("PDF_RENDERER", "direct" if HAS_REPORTLAB else "latex")
+HEADER_COLOR = '#add8e6'
+
+# Competitor cinemas tracked in each city, edited with /competitor by the chats in ADMIN_CHAT_IDS
+COMPETITORS_FILE = os.environ.get("COMPETITORS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "competitors.json"))
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.environ.get("ADMIN_CHAT_IDS", "").split(",") if chat_id.strip()}
+
+COLUMN_AGGREGATED_LABELS = ['Sala', 'Incassi totali', 'Presenze totali', 'Prezzo medio']
+COLUMN_DETAILED_LABELS = ['Film', 'Incassi', 'Presenze', 'Prezzo medio']
+COLUMN_TREND_LABELS = ['Var. incassi', 'Var. presenze']
+
+# Weekly totals of every analysis are kept here to compare each week with the previous one
+HISTORY_DB = os.environ.get("HISTORY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.sqlite3"))
+
+# Columns of the box-office export that the report needs
+TEXT_COLUMNS = ["Città", "Cinema", "Titolo Film"]
+# Hash of the whole source row, kept next to the report columns to drop repeated rows
+ROW_FINGERPRINT = "Impronta"
+
+# Upper bound for the rows preallocated from a worksheet's declared dimensions
+MAX_ROWS_HINT = 100_000
+
+# Number of worker processes used to parse the uploaded workbooks
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", os.cpu_count() or 1))
+
+# Number of worker processes rendering report pages, how many jobs run side by side
+# and how many jobs a single chat may have open
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", 2))
+MAX_JOBS_PER_CHAT = int(os.environ.get("MAX_JOBS_PER_CHAT", 1))
+
+# Minimum number of seconds between two edits of a job's progress message
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 3))
+
+# Outbound HTTP goes through one pooled client, /mario serves jokes prefetched from JOKE_API_URL
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 5))
+JOKE_API_URL = os.environ.get("JOKE_API_URL", "https://official-joke-api.appspot.com/random_joke")
+JOKE_CACHE_SIZE = int(os.environ.get("JOKE_CACHE_SIZE", 5))
+JOKE_TTL = int(os.environ.get("JOKE_TTL", 60 * 60))
+
+http_client = None
+
+parse_pool = None
+render_pool = None
+
+# Modules every new worker of the pools imports before taking work, and whether the workers
+# are all started in the background as soon as the bot is up
+PARSE_MODULES = ["pd", "np", "openpyxl"]
+RENDER_MODULES = ["pd", "np"] + (["pdf_canvas", "pdfmetrics"] if PDF_RENDERER == "direct" else ["plt", "backend_pdf"]) + (["pypdf"] if HAS_PYPDF else [])
+PREWARM_WORKERS = os.environ.get("PREWARM_WORKERS", "1") == "1"
+
+# Report jobs waiting or running, shared by the handlers and the report workers
+job_queue = asyncio.Queue()
+jobs = {}
+job_ids = itertools.count(1)
+
+# Where each chat's reports are written, and how long an idle workspace is kept before it is removed
+WORKSPACES_DIR = os.environ.get("WORKSPACES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "workspaces"))
+WORKSPACE_TTL = int(os.environ.get("WORKSPACE_TTL", 24 * 60 * 60))
+WORKSPACE_CLEANUP_INTERVAL = 10 * 60
+
+# Parsed workbooks are cached as Parquet by content hash, the cache needs pyarrow and is skipped without it
+CACHE_DIR = os.environ.get("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 512 * 1024 * 1024))
+CACHE_MAX_AGE = int(os.environ.get("CACHE_MAX_AGE", 30 * 24 * 60 * 60))
+# Part of every cache key, bump it whenever the parsing changes so older entries are no longer used
+PARSER_VERSION = 3
+
+# Timings of the last METRICS_WINDOW runs of each stage are kept for /metrics, and served as
+# Prometheus text on METRICS_HOST:METRICS_PORT when a port is set
+METRICS_WINDOW = int(os.environ.get("METRICS_WINDOW", 500))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_QUANTILES = [0.5, 0.9, 0.99]
+
+def reset_peak_rss():
+    # Linux lets a process reset its memory high-water mark, so the peak read afterwards belongs to a
+    # single stage and not to the whole life of the worker. False where it cannot, e.g. macOS and Windows
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    # VmHWM, the peak resident memory since the last reset, in MB
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+def measured(func, *args):
+    # Runs in a worker process: call func and report how long it took and the worker's peak memory
+    # during the call, None where it cannot be measured
+    measure_rss = reset_peak_rss()
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start, peak_rss_mb() if measure_rss else None
+
+class StageMetrics:
+    # Durations, rows, bytes and peak memory of every pipeline stage. Each run is logged as a
+    # JSON record on the "metrics" logger and the latest ones are kept for the percentiles
+    def __init__(self, window):
+        self.durations = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.counts = collections.Counter()
+        self.seconds = collections.Counter()
+        self.rows = collections.Counter()
+        self.bytes = collections.Counter()
+        self.peak_rss = {}
+        self.logger = logging.getLogger(f"{__name__}.metrics")
+
+    def record(self, stage, seconds, rows=None, n_bytes=None, peak_rss=None, **fields):
+        # peak_rss is only known for the stages run in a worker, the bot process serves several jobs at once
+        self.durations[stage].append(seconds)
+        self.counts[stage] += 1
+        self.seconds[stage] += seconds
+        self.rows[stage] += rows or 0
+        self.bytes[stage] += n_bytes or 0
+        if peak_rss is not None:
+            self.peak_rss[stage] = max(self.peak_rss.get(stage, 0), peak_rss)
+            peak_rss = round(peak_rss, 1)
+
+        event = {"stage": stage, "seconds": round(seconds, 4), "rows": rows, "bytes": n_bytes, "peak_rss_mb": peak_rss, **fields}
+        self.logger.info(json.dumps({key: value for key, value in event.items() if value is not None}, default=str), extra={"metrics": event})
+
+    def percentiles(self, stage):
+        return np.quantile(np.array(self.durations[stage]), METRICS_QUANTILES)
+
+    def summary(self):
+        lines = []
+        for stage in self.counts:
+            p50, p90, p99 = self.percentiles(stage)
+            line = f"{stage}: {self.counts[stage]} volte, p50 {p50:.2f}s, p90 {p90:.2f}s, p99 {p99:.2f}s"
+            if stage in self.peak_rss:
+                line += f", picco {self.peak_rss[stage]:.0f} MB"
+            if self.rows[stage]:
+                line += f", {self.rows[stage]} righe"
+            if self.bytes[stage]:
+                line += f", {self.bytes[stage] / 1024 / 1024:.1f} MB"
+            lines.append(line)
+        return lines
+
+    def prometheus(self):
+        lines = ["# TYPE excelbot_stage_seconds summary"]
+        for stage in self.counts:
+            for quantile, value in zip(METRICS_QUANTILES, self.percentiles(stage)):
+                lines.append(f'excelbot_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {value:.6f}')
+            lines.append(f'excelbot_stage_seconds_sum{{stage="{stage}"}} {self.seconds[stage]:.6f}')
+            lines.append(f'excelbot_stage_seconds_count{{stage="{stage}"}} {self.counts[stage]}')
+
+        for name, kind, values in [("rows_total", "counter", self.rows), ("bytes_total", "counter", self.bytes), ("peak_rss_megabytes", "gauge", self.peak_rss)]:
+            lines.append(f"# TYPE excelbot_stage_{name} {kind}")
+            for stage in self.counts:
+                if stage in values:
+                    lines.append(f'excelbot_stage_{name}{{stage="{stage}"}} {values[stage]}')
+
+        return "\n".join(lines) + "\n"
+
+metrics = StageMetrics(METRICS_WINDOW)
+
+def is_report_column(col):
+    return col in TEXT_COLUMNS or "Incass" in col.split()[0] or "Presenz" in col
+
+class ColumnBuffer:
+    # Growable columnar storage shared by all the workbooks of an analysis,
+    # so rows are appended in place instead of building and concatenating one DataFrame per file
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.n_rows = 0
+        self.columns = {}
+
+    def _new_column(self, col):
+        if col in TEXT_COLUMNS:
+            return np.full(self.capacity, None, dtype=object)
+        if col == ROW_FINGERPRINT:
+            return np.zeros(self.capacity, dtype=np.int64)
+        return np.zeros(self.capacity, dtype=np.float64)
+
+    def reserve(self, n_rows):
+        needed = self.n_rows + n_rows
+        if needed <= self.capacity:
+            return
+
+        self.capacity = max(needed, 2 * self.capacity)
+        for col, values in self.columns.items():
+            resized = self._new_column(col)
+            resized[:self.n_rows] = values[:self.n_rows]
+            self.columns[col] = resized
+
+    def append(self, header, row, fingerprint):
+        self.reserve(1)
+        if ROW_FINGERPRINT not in self.columns:
+            self.columns[ROW_FINGERPRINT] = self._new_column(ROW_FINGERPRINT)
+        self.columns[ROW_FINGERPRINT][self.n_rows] = fingerprint
+
+        for i, col in header.items():
+            if col not in self.columns:
+                self.columns[col] = self._new_column(col)
+
+            value = row[i] if i < len(row) else None
+            if col in TEXT_COLUMNS:
+                # Titles such as 1917 come as numbers, keys are always kept as text
+                self.columns[col][self.n_rows] = None if value is None else str(value)
+            elif value is not None:
+                self.columns[col][self.n_rows] = float(value)
+        self.n_rows += 1
+
+    def extend(self, other):
+        self.reserve(other.n_rows)
+        for col, values in other.columns.items():
+            if col not in self.columns:
+                self.columns[col] = self._new_column(col)
+            self.columns[col][self.n_rows:self.n_rows + other.n_rows] = values[:other.n_rows]
+        self.n_rows += other.n_rows
+
+    def trimmed(self):
+        # Copy without the unused capacity, so only the filled rows are sent back from a worker
+        buffer = ColumnBuffer(capacity=self.n_rows)
+        buffer.extend(self)
+        return buffer
+
+    @classmethod
+    def from_frame(cls, df):
+        buffer = cls(capacity=len(df))
+        for col in df.columns:
+            buffer.columns[col] = df[col].to_numpy(dtype=object if col in TEXT_COLUMNS else np.int64 if col == ROW_FINGERPRINT else np.float64, copy=True)
+        buffer.n_rows = len(df)
+        return buffer
+
+    def to_frame(self):
+        data = {}
+        for col, values in self.columns.items():
+            values = values[:self.n_rows]
+            # Keep whole-number columns (e.g. presenze) as integers like read_excel does
+            if values.dtype != object and np.array_equal(values, np.floor(values)):
+                values = values.astype(np.int64)
+            data[col] = values
+        return pd.DataFrame(data)
+
+def unique_labels(labels):
+    # Exports with a row of days above the header repeat "Incassi" and "Presenze" for every day,
+    # repeated labels get a ".1", ".2" suffix as pandas gives them so no column overwrites another
+    seen = collections.Counter()
+    unique = []
+    for label in labels:
+        if isinstance(label, str) and seen[label] > 0:
+            unique.append(f"{label}.{seen[label]}")
+        else:
+            unique.append(label)
+        seen[label] += 1
+    return unique
+
+def row_fingerprint(labels, row):
+    # Hash of every labelled cell of a data row, not only of the columns the report keeps, so two rows
+    # that differ only in Sala, Distributore or date are both counted. Cells compare as in the original
+    # merge of whole rows: title-cased keys, numbers by value and empty cells equal to zero
+    cells = []
+    for label, value in zip(labels, row):
+        if label is None or value is None or value == 0 or value == "":
+            continue
+        if label in TEXT_COLUMNS:
+            value = str(value).title()
+        elif isinstance(value, (int, float)):
+            value = float(value)
+        cells.append(f"{label}\x1f{value!r}")
+
+    digest = hashlib.blake2b("\x1e".join(cells).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+def append_box_office_rows(rows, buffer, max_row=None):
+    # Find the header row and append the report columns of the data rows to the buffer
+    header = None
+
+    for row in rows:
+        # Everything above the row holding the column names is the export's title block
+        if header is None:
+            if all(col in row for col in TEXT_COLUMNS):
+                labels = [label if isinstance(label, str) else None for label in unique_labels(row)]
+                header = {i: col for i, col in enumerate(labels) if col is not None and is_report_column(col)}
+                if max_row:
+                    buffer.reserve(min(max_row, MAX_ROWS_HINT))
+            continue
+
+        # Blank lines and the totals at the bottom have no cinema or film
+        key_values = [row[i] if i < len(row) else None for i, col in header.items() if col in TEXT_COLUMNS]
+        if any(value is None or value == "" for value in key_values):
+            continue
+
+        buffer.append(header, row, row_fingerprint(labels, row))
+
+    if header is None:
+        raise ValueError("Header row not found in the first worksheet")
+
+def read_box_office_file(file_in, buffer):
+    # Stream the rows of the first worksheet with openpyxl
+    workbook = openpyxl.load_workbook(file_in, read_only=True, data_only=True)
 
-async def process_xlsx_to_excel(update: Update, context):
-    # Predefined data
-    cities = {'Roma':['Troisi', 'Barberini', 'Quattro Fontane', 'Farnese', 'Intrastevere', 'Nuovo Sacher', 'Greenwich'], 'Milano':['Beltrade'], 'Bologna':['Cinema Modernissimo'], 'Trento':['Roma']}
+    try:
+        sheet = workbook.worksheets[0]
+        append_box_office_rows(sheet.iter_rows(values_only=True), buffer, sheet.max_row)
+    finally:
+        workbook.close()
+
+def xml_tag(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+def column_index(cell_ref):
+    # "AB12" -> 27
+    index = 0
+    for ch in cell_ref:
+        if ch not in alphabet_to_index:
+            break
+        index = index * 26 + alphabet_to_index[ch] + 1
+    return index - 1
+
+def xml_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
 
-    column_aggregated_labels = ['Sala', 'Incassi totali', 'Presenze totali', 'Prezzo medio']
-    column_detailed_labels = ['Film', 'Incassi', 'Presenze', 'Prezzo medio']
+def repair_workbook(data):
+    # Rewrite the parts our box-office exports get wrong: the stylesheet is replaced with a minimal
+    # valid one (the report reads values only) and the worksheet dimension records are dropped
+    repaired = io.BytesIO()
 
-    print("Processing files sent...")
+    with zipfile.ZipFile(io.BytesIO(data)) as source, zipfile.ZipFile(repaired, 'w', zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            content = source.read(item.filename)
+            if item.filename == 'xl/styles.xml':
+                content = MINIMAL_STYLESHEET
+            elif item.filename.startswith('xl/worksheets/') and item.filename.endswith('.xml'):
+                content = re.sub(rb'<(\w+:)?dimension\b[^>]*/>', b'', content, count=1)
+            target.writestr(item.filename, content)
 
-    # List Excel files in the current directory
-    results = [each for each in os.listdir(".") if each.endswith('.xlsx')]
+    return repaired.getvalue()
 
-    if len(results) > 0:
-        dfs = []
+def first_worksheet_path(archive):
+    names = archive.namelist()
 
-        # Process each Excel file
-        for file in results:
-            full_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file)
+    try:
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+        sheet = next(el for el in workbook.iter() if xml_tag(el) == 'sheet')
+        rel_id = next(value for key, value in sheet.attrib.items() if key.rsplit('}', 1)[-1] == 'id')
+        target = next(el.get('Target') for el in rels.iter() if xml_tag(el) == 'Relationship' and el.get('Id') == rel_id)
+        path = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+        if path in names:
+            return path
+    except (KeyError, StopIteration, ElementTree.ParseError):
+        pass
+
+    # Broken workbook part or relationships, fall back on the first worksheet in the archive
+    return sorted(name for name in names if name.startswith('xl/worksheets/') and name.endswith('.xml'))[0]
+
+def read_box_office_xml(data, buffer):
+    # Lenient streaming reader working straight on the worksheet XML, ignoring styles
+    # and dimensions altogether, for workbooks that openpyxl refuses even once repaired
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        shared_strings = []
+        if 'xl/sharedStrings.xml' in archive.namelist():
+            with archive.open('xl/sharedStrings.xml') as part:
+                for _, element in ElementTree.iterparse(part):
+                    if xml_tag(element) == 'si':
+                        shared_strings.append("".join(el.text or "" for el in element.iter() if xml_tag(el) == 't'))
+                        element.clear()
+
+        def iter_rows(part):
+            for _, element in ElementTree.iterparse(part):
+                if xml_tag(element) != 'row':
+                    continue
 
+                row = {}
+                for i, cell in enumerate(el for el in element if xml_tag(el) == 'c'):
+                    cell_type = cell.get('t', 'n')
+                    col = column_index(cell.get('r')) if cell.get('r') else i
+                    value = next((el.text for el in cell if xml_tag(el) == 'v'), None)
+
+                    if cell_type == 'inlineStr':
+                        row[col] = "".join(el.text or "" for el in cell.iter() if xml_tag(el) == 't')
+                    elif value is None:
+                        continue
+                    elif cell_type == 's':
+                        row[col] = shared_strings[int(value)] if int(value) < len(shared_strings) else None
+                    elif cell_type in ('str', 'e'):
+                        row[col] = value
+                    elif cell_type == 'b':
+                        row[col] = value == '1'
+                    else:
+                        row[col] = xml_number(value)
+
+                element.clear()
+                yield tuple(row.get(i) for i in range(max(row) + 1)) if row else ()
+
+        with archive.open(first_worksheet_path(archive)) as part:
+            append_box_office_rows(iter_rows(part), buffer)
+
+class ParsedWorkbookCache:
+    # Parsed workbooks stored as Parquet files named after the SHA-256 of the parser version and
+    # the uploaded bytes. The file's mtime is its last use, so eviction drops the least recently
+    # used entries first, entries of older parser versions included
+    def __init__(self, root, max_bytes, max_age):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.enabled = importlib.util.find_spec("pyarrow") is not None
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, data):
+        if not self.enabled:
+            return None
+
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, hashlib.sha256(f"v{PARSER_VERSION}:".encode() + data).hexdigest() + ".parquet")
+
+    def evict(self):
+        if not os.path.isdir(self.root):
+            return
+
+        now = time.time()
+        entries = []
+        for file in os.listdir(self.root):
+            file_path = os.path.join(self.root, file)
             try:
-                df = pd.read_excel(full_path)
-            except ValueError as e:
-                clean_file(full_path)
-                df = pd.read_excel(full_path)
-
-            # Clean up DataFrame
-            df.columns = list(df.iloc[1])
-            df = df[2:-2].reset_index(drop=True)
-            dfs.append(df)
-
-        # Merge all DataFrames
-        df_merged = pd.concat(dfs, ignore_index=True, sort=False)
-        df_merged.fillna(0, inplace=True)
-        df_merged["Città"] = df_merged["Città"].str.title()
-        df_merged["Cinema"] = df_merged["Cinema"].str.title()
-        df_merged["Titolo Film"] = df_merged["Titolo Film"].str.title()
-        df_merged.drop_duplicates(inplace=True)
-
-        df_merged = df_merged.loc[df_merged['Città'].isin(list(cities.keys()))]
-
-        # Filter cinema names and create a dictionary of DataFrames for each cinema
-        names = []
-        [names.extend(c) for c in cities.values()]
-        cinema_names = list(set(names).intersection(list(df_merged["Cinema"])))
-        df_cinemas = {name: filter_cinema(df_merged, name) for name in cinema_names}
-
-        # Extract relevant columns
-        columns_incasso = [col for col in df_merged.columns if "Incass" in col.split()[0]]
-        columns_presenze = [col for col in df_merged.columns if "Presenz" in col]
-
-        # Filter cities and create a dictionary of DataFrames for each city
-        filtered_cities = list(set(cities.keys()).intersection(list(df_merged["Città"])))
-        df_cinema_city = {city: df_merged.loc[df_merged['Città'] == city] for city in filtered_cities}
-
-        # Get current datetime for file naming
-        current_datetime = datetime.now()
-        formatted_date = current_datetime.strftime("%d_%m_%Y")
-        full_name = f'Analisi_{formatted_date}.xlsx'
-
-        writer = pd.ExcelWriter(full_name, engine='xlsxwriter')
-
-        table_data = {}
-
-        to_remove = []
-
-        # Iterate over each city
-        for city in filtered_cities:
-            curr_df = df_cinema_city[city]
-            curr_keys = list(set(names).intersection(list(curr_df["Cinema"])))
-
-            if len(curr_keys) == 0:
-                print(f"No matching cinema for {city}")
-                to_remove.append(city)
+                stat = os.stat(file_path)
+            except FileNotFoundError:
                 continue
 
-            dati_per_cinema = {name: [round(sum([sum(df_cinemas[name][key]) for key in columns_incasso]), 2)] for name in curr_keys}
-            {dati_per_cinema[name].append(round(sum([sum(df_cinemas[name][key].apply(pd.to_numeric)) for key in columns_presenze]), 2)) for name in curr_keys}
-            {dati_per_cinema[key].append(round(value[0] / value[1], 2)) for key, value in dati_per_cinema.items()}
-
-            table_data[city] = [[key] + dati_per_cinema[key] for key in curr_keys]
-
-        # Remove cities with no matching cinema
-        [filtered_cities.remove(val) for val in to_remove]
-
-        rome_table_data = False
-
-        if "Roma" in list(table_data.keys()):
-            # Sort and create a table for Rome only
-            rome_table_data = copy.deepcopy(table_data["Roma"])
-            rome_table_data.sort(key=lambda x: (-x[2]))
-            rome_df = pd.DataFrame(rome_table_data, columns=column_aggregated_labels)
-            rome_df.to_excel(writer, sheet_name='Roma', index=False)
-
-            # Create a table for other cities
-            troisi_data = [val for val in rome_table_data if val[0] == "Troisi"]
-            troisi_data[0].insert(0, "Roma")
-            troisi_data = troisi_data[0]
-            other_cities_data = [[[c] + el for el in table_data[c]] for c in filtered_cities if c != "Roma"]
-            other_cities_data = [i for row in other_cities_data for i in row]
-            if rome_table_data:
-                other_cities_data.append(troisi_data)
-            other_cities_df = pd.DataFrame(other_cities_data, columns=['Città'] + column_aggregated_labels)
-            other_cities_df.to_excel(writer, sheet_name='Altre Città', index=False)
+            if now - stat.st_mtime > self.max_age:
+                os.remove(file_path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, file_path))
 
-        # Create detailed analysis for each cinema
-        if "Roma" in list(table_data.keys()):
-            sorted_cinema_names = [val[0] for val in table_data["Roma"]]
-            sorted_cinema_names.extend([table_data[key][0][0] for key in table_data.keys() if key != "Roma"])
-            df_cinemas["Roma"] = df_cinemas["Roma"][df_cinemas["Roma"]["Città"] == "Trento"]
-        else:
-            sorted_cinema_names = [table_data[key][0][0] for key in table_data.keys()]
-
-        for cinema in sorted_cinema_names:
-            table_data = []
-            movies = df_cinemas[cinema]["Titolo Film"]
-            incassi_totali = 0
-            presenze_totali = 0
-
-            for i, movie in enumerate(movies):
-                target_row = df_cinemas[cinema].loc[df_merged['Titolo Film'] == movie]
-                incassi_film = target_row[columns_incasso].apply(pd.to_numeric).sum().sum()
-                presenze_film = target_row[columns_presenze].apply(pd.to_numeric).sum().sum()
-                costo_medio = round(incassi_film / presenze_film, 2)
-                table_data.append([twp.fill(movie, 40), round(incassi_film, 2), presenze_film, costo_medio])
-                incassi_totali += incassi_film
-                presenze_totali += presenze_film
-
-            table_data.sort(key=lambda x: (-x[2]))
-            table_data.append(['Totale', round(incassi_totali, 2), presenze_totali, round(incassi_totali / presenze_totali, 2)])
-            detailed_df = pd.DataFrame(table_data, columns=column_detailed_labels)
-            detailed_df.to_excel(writer, sheet_name=cinema, index=False)
-
-        writer.save()
-
-        await context.bot.send_document(update.message.chat_id, document=open(full_name, 'rb'))
-    else:
-        await update.message.reply_text("Non ho trovato file excel (.xlsx), fai l'upload dei file prima.")
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_path in entries:
+            if total_size <= self.max_bytes:
+                break
+            os.remove(file_path)
+            total_size -= size
 
-    current_directory = os.getcwd()
+parsed_cache = ParsedWorkbookCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_MAX_AGE)
 
-    # List all files in the current directory
-    files = os.listdir(current_directory)
+def load_cached_file(cache_file):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return None
 
-    # Iterate through the files and remove each one, excluding those ending with ".py"
-    for file in files:
-        file_path = os.path.join(current_directory, file)
-        if os.path.isfile(file_path) and not file.endswith(".py"):
-            os.remove(file_path)
+    try:
+        buffer = ColumnBuffer.from_frame(pd.read_parquet(cache_file))
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable cache entry {cache_file}: {e}")
+        return None
+
+    os.utime(cache_file)
+    return buffer
+
+def store_cached_file(cache_file, buffer):
+    # Write under a temporary name first, so a concurrent reader never sees a partial file
+    fd, part_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(cache_file))
+    os.close(fd)
+    try:
+        pd.DataFrame({col: values[:buffer.n_rows] for col, values in buffer.columns.items()}).to_parquet(part_path, index=False)
+        os.replace(part_path, cache_file)
+    except Exception as e:
+        logger.warning(f"Could not cache parsed workbook: {e}")
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+
+def read_cached_file(cache_file):
+    # Runs in a worker process: the cached buffer of an upload parsed before, None if it cannot be read
+    measure_rss = reset_peak_rss()
+    start = time.perf_counter()
+
+    buffer = load_cached_file(cache_file)
+    if buffer is None:
+        return None
+    return buffer, time.perf_counter() - start, "cache", peak_rss_mb() if measure_rss else None
+
+def parse_box_office_file(data, cache_file=None):
+    # Runs in a worker process: parse a single uploaded workbook into its own buffer,
+    # and cache it when a cache file is given
+    measure_rss = reset_peak_rss()
+    start = time.perf_counter()
 
+    try:
+        reader = "openpyxl"
+        buffer = ColumnBuffer()
+        read_box_office_file(io.BytesIO(data), buffer)
+    except Exception as e:
+        # Malformed export, repair it in memory and if openpyxl still refuses it read the XML directly
+        logger.warning(f"Repairing workbook after read error: {e!r}")
+        try:
+            reader = "repair"
+            buffer = ColumnBuffer()
+            read_box_office_file(io.BytesIO(repair_workbook(data)), buffer)
+        except Exception as e:
+            logger.warning(f"Falling back on the lenient reader after read error: {e!r}")
+            reader = "lenient"
+            buffer = ColumnBuffer()
+            read_box_office_xml(data, buffer)
+
+    buffer = buffer.trimmed()
+    if cache_file is not None:
+        store_cached_file(cache_file, buffer)
+
+    return buffer, time.perf_counter() - start, reader, peak_rss_mb() if measure_rss else None
+
+def load_modules(names):
+    # Runs in every new worker process
+    for name in names:
+        globals()[name]._load()
+
+def get_parse_pool():
+    global parse_pool
+
+    if parse_pool is None:
+        parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, initializer=load_modules, initargs=(PARSE_MODULES,))
+    return parse_pool
+
+def log_parse_result(file_name, n_bytes, future):
+    global parse_pool
+
+    if future.cancelled():
+        return
+
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Could not parse {file_name}", exc_info=error)
+        if isinstance(error, BrokenProcessPool):
+            parse_pool = None
+        return
+
+    file_buffer, elapsed, reader, peak_rss = future.result()
+    cache_hit = reader == "cache"
+    if cache_hit:
+        parsed_cache.hits += 1
+    else:
+        parsed_cache.misses += 1
+        parsed_cache.evict()
+
+    logger.info(f"Parsed {file_name}: {file_buffer.n_rows} rows in {elapsed:.2f}s (cache {'hit' if cache_hit else 'miss'}, {parsed_cache.hits} hits / {parsed_cache.misses} misses)")
+    # The repaired and lenient reads are the slow fallbacks, they get their own stage
+    metrics.record("parse" if reader in ["openpyxl", "cache"] else f"parse_{reader}", elapsed, file_buffer.n_rows, n_bytes, peak_rss, reader=reader)
+
+async def parse_upload(data, cache_file):
+    # On a cache hit only the path goes to the worker, the upload itself is sent only to be parsed
+    loop = asyncio.get_running_loop()
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        result = await loop.run_in_executor(get_parse_pool(), read_cached_file, cache_file)
+        if result is not None:
+            return result
+
+    return await loop.run_in_executor(get_parse_pool(), parse_box_office_file, data, cache_file)
+
+def start_parse(file_name, data):
+    # Parse an upload on the parse pool as soon as it arrives, while the user is still sending files
+    future = asyncio.ensure_future(parse_upload(data, parsed_cache.path(data)))
+    future.add_done_callback(functools.partial(log_parse_result, file_name, len(data)))
+    return future
+
+async def parse_uploaded_files(uploads):
+    # Wait for the uploads still being parsed and merge them in upload order
+    results = await asyncio.gather(*[future for _, future in uploads], return_exceptions=True)
+
+    start = time.perf_counter()
+    buffer = ColumnBuffer()
+    failed = []
+
+    for (file_name, _), result in zip(uploads, results):
+        if isinstance(result, BaseException):
+            failed.append(file_name)
+            continue
+
+        buffer.extend(result[0])
+
+    metrics.record("merge", time.perf_counter() - start, buffer.n_rows, files=len(uploads) - len(failed))
+    return buffer, failed
+
+def title_categorical(values):
+    # Title-case every distinct string once and encode the column against the resulting dictionary,
+    # spellings that only differ in case ("ROMA", "Roma") end up sharing a code
+    codes, uniques = pd.factorize(values)
+    titled_codes, titled = pd.factorize(pd.Index(uniques, dtype=object).astype(str).str.title())
+    codes = np.where(codes >= 0, titled_codes[codes], -1)
+    return pd.Categorical.from_codes(codes, categories=titled)
+
+class CinemaRegistry:
+    # The tracked (city, cinema) pairs loaded from COMPETITORS_FILE, with a lookup table giving
+    # every pair an id, so rows are matched on the pair and Cinema Roma in Trento never
+    # gets mixed up with a cinema called Roma in Rome. The home cinema is the one compared with
+    # the competitors of its city and of the other cities
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'r', encoding='utf-8') as file:
+            config = json.load(file)
+        self.home = (config["home"]["Città"], config["home"]["Cinema"])
+        self.cities = config["cities"]
+        self.build_index()
+
+    def build_index(self):
+        self.keys = [(city, cinema) for city, cinemas in self.cities.items() for cinema in cinemas]
+        self.ids = {key: cinema_id for cinema_id, key in enumerate(self.keys)}
+
+    def save(self):
+        fd, part_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump({"home": {"Città": self.home[0], "Cinema": self.home[1]}, "cities": self.cities}, file, ensure_ascii=False, indent=4)
+        os.replace(part_path, self.path)
+
+    def add(self, city, cinema):
+        if cinema in self.cities.get(city, []):
+            return False
+        self.cities.setdefault(city, []).append(cinema)
+        self.build_index()
+        self.save()
+        return True
+
+    def set_home(self, city, cinema):
+        self.add(city, cinema)
+        self.home = (city, cinema)
+        self.save()
+
+    def remove(self, city, cinema):
+        if cinema not in self.cities.get(city, []):
+            return False
+        self.cities[city].remove(cinema)
+        if len(self.cities[city]) == 0:
+            del self.cities[city]
+        self.build_index()
+        self.save()
+        return True
+
+    def match(self, df):
+        # One merge against the lookup table keeps the tracked rows and tags them with their cinema id.
+        # The lookup table is encoded with the frame's own categories so the join runs on integer codes
+        index = pd.DataFrame({
+            "Città": pd.Categorical([city for city, _ in self.keys], categories=df["Città"].cat.categories),
+            "Cinema": pd.Categorical([cinema for _, cinema in self.keys], categories=df["Cinema"].cat.categories),
+            "cinema_id": np.arange(len(self.keys)),
+        })
+        index = index.dropna(subset=["Città", "Cinema"])
+        return df.merge(index, on=["Città", "Cinema"], how="inner", sort=False)
+
+competitors = CinemaRegistry(COMPETITORS_FILE)
+
+def aggregate_box_office(df_merged, registry):
+    # Extract relevant columns
+    columns_incasso = [col for col in df_merged.columns if "Incass" in col.split()[0]]
+    columns_presenze = [col for col in df_merged.columns if "Presenz" in col]
+
+    # Coerce the numeric columns once and collapse them to one total per row
+    df_totals = df_merged[["cinema_id", "Titolo Film"]].copy()
+    df_totals["Incassi"] = df_merged[columns_incasso].apply(pd.to_numeric).sum(axis=1)
+    df_totals["Presenze"] = df_merged[columns_presenze].apply(pd.to_numeric).sum(axis=1)
+
+    # Single groupby pass for the per-film totals, cinema totals are derived from it
+    per_film = df_totals.groupby(["cinema_id", "Titolo Film"], sort=False, observed=True)[["Incassi", "Presenze"]].sum()
+    per_cinema = per_film.groupby(level="cinema_id", sort=False).sum()
+
+    # Prezzo medio of every film and cinema, a film without presenze in the week has none (NaN)
+    for totals in [per_film, per_cinema]:
+        totals["Prezzo medio"] = (totals["Incassi"] / totals["Presenze"].replace(0, np.nan)).round(2)
+
+    # Aggregated table for each city: [cinema, incassi, presenze, prezzo medio]
+    table_data = {}
+    for city, cinemas in registry.cities.items():
+        for name in cinemas:
+            cinema_id = registry.ids[(city, name)]
+            if cinema_id not in per_cinema.index:
+                continue
 
+            incassi = round(per_cinema.at[cinema_id, "Incassi"], 2)
+            presenze = round(per_cinema.at[cinema_id, "Presenze"], 2)
+            table_data.setdefault(city, []).append([name, incassi, presenze, per_cinema.at[cinema_id, "Prezzo medio"]])
+
+    # Detailed table for each cinema: film rows sorted by presenze plus the totals
+    detailed_data = {}
+    for cinema_id, films in per_film.groupby(level="cinema_id", sort=False):
+        film_rows = []
+        for title, incassi_film, presenze_film, prezzo_medio in zip(films.index.get_level_values("Titolo Film"), films["Incassi"], films["Presenze"], films["Prezzo medio"]):
+            film_rows.append([title, round(incassi_film, 2), presenze_film, prezzo_medio])
+        film_rows.sort(key=lambda x: (-x[2]))
+
+        incassi_totali = per_cinema.at[cinema_id, "Incassi"]
+        presenze_totali = per_cinema.at[cinema_id, "Presenze"]
+        detailed_data[registry.keys[cinema_id]] = (film_rows, [round(incassi_totali, 2), presenze_totali, per_cinema.at[cinema_id, "Prezzo medio"]])
+
+    return table_data, detailed_data
+
+def sort_cinema_pages(table_data, home_city):
+    # The cinemas of the home city come first, followed by the competitors in the other cities
+    cinema_pages = [(city, row[0]) for city, rows in table_data.items() for row in rows]
+    cinema_pages.sort(key=lambda x: x[0] != home_city)
+    return cinema_pages
+
+class HistoryStore:
+    # SQLite store of the per-film totals of every analysed week. Re-analysing a week replaces the
+    # films of every cinema it covers, and the primary key (city, cinema, week, film) turns the
+    # previous week lookup into an index range scan
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS box_office (
+            week TEXT NOT NULL,
+            city TEXT NOT NULL,
+            cinema TEXT NOT NULL,
+            film TEXT NOT NULL,
+            incassi REAL NOT NULL,
+            presenze REAL NOT NULL,
+            PRIMARY KEY (city, cinema, week, film)
+        ) WITHOUT ROWID""")
+        return connection
+
+    def merge_week(self, week, cinema_tables):
+        # Each cinema's week is replaced as a whole in one transaction, films missing from a corrected
+        # export do not linger from the earlier upload
+        partitions = [(week, city, cinema) for city, cinema, _, _ in cinema_tables]
+        rows = [(week, city, cinema, film_row[0], float(film_row[1]), float(film_row[2]))
+                for city, cinema, film_rows, _ in cinema_tables for film_row in film_rows]
+
+        with contextlib.closing(self.connect()) as connection, connection:
+            connection.executemany("DELETE FROM box_office WHERE week = ? AND city = ? AND cinema = ?", partitions)
+            connection.executemany("INSERT INTO box_office VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def previous_week_totals(self, week, keys):
+        # {(city, cinema): (incassi, presenze)} of the latest week before this one
+        totals = {}
+
+        with contextlib.closing(self.connect()) as connection:
+            for city, cinema in keys:
+                row = connection.execute("""SELECT SUM(incassi), SUM(presenze) FROM box_office
+                    WHERE city = ? AND cinema = ? AND week = (
+                        SELECT MAX(week) FROM box_office WHERE city = ? AND cinema = ? AND week < ?
+                    )""", (city, cinema, city, cinema, week)).fetchone()
+                if row[0] is not None:
+                    totals[(city, cinema)] = row
+
+        return totals
+
+history_store = HistoryStore(HISTORY_DB)
+
+# Date formats accepted for the week in /analizza and /excel
+WEEK_DATE_FORMATS = ["%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d"]
+
+def cinema_week(day):
+    # Box-office weeks run from Thursday to Wednesday, each one is stored under the ISO week of its Thursday
+    thursday = day - timedelta(days=(day.weekday() - 3) % 7)
+    return thursday.strftime("%G-W%V")
+
+def last_cinema_week(today):
+    # The latest week that is already over, the exports are analysed after their week has ended
+    return cinema_week(today - timedelta(days=(today.weekday() - 2) % 7 or 7))
+
+def parse_week_argument(arg):
+    # A date in the week the uploaded exports cover, None when the argument is not a date
+    for date_format in WEEK_DATE_FORMATS:
+        try:
+            return cinema_week(datetime.strptime(arg, date_format))
+        except ValueError:
+            continue
+    return None
+
+def trend(current, previous):
+    if not previous:
+        return "-"
+    return f"{(current - previous) / previous * 100:+.1f}%"
+
+class ReportModel:
+    # Everything the renderers need, built once per job from the parsed uploads
+    def __init__(self, home_city, home_table, national_table, cinema_tables):
+        self.home_city = home_city
+        # [cinema, incassi, presenze, prezzo medio, var. incassi, var. presenze] rows of the home city's competitors,
+        # None without data for the home city
+        self.home_table = home_table
+        # Same rows with the city in front, for the other cities plus the home cinema
+        self.national_table = national_table
+        # (city, cinema, film rows, total row) for every cinema in page order
+        self.cinema_tables = cinema_tables
+
+def build_report_model(buffer, week, registry):
+    # Build the merged DataFrame from the buffered columns
+    df_merged = buffer.to_frame()
+    for col in TEXT_COLUMNS:
+        df_merged[col] = title_categorical(df_merged[col])
+    # Rows whose keys could not be read are left out of the report, but not silently
+    missing_keys = df_merged[TEXT_COLUMNS].isna().any(axis=1)
+    if missing_keys.any():
+        logger.warning(f"Dropping {missing_keys.sum()} rows without {', '.join(TEXT_COLUMNS)}")
+        df_merged = df_merged[~missing_keys]
+    # The same row uploaded twice, e.g. in overlapping exports, is counted once
+    df_merged = df_merged.drop_duplicates(subset=[ROW_FINGERPRINT])
+
+    # Keep the competitor cinemas of the tracked cities
+    df_merged = registry.match(df_merged)
+
+    # Aggregate incassi and presenze per city, cinema and film
+    table_data, detailed_data = aggregate_box_office(df_merged, registry)
+
+    # Compare every cinema with its previous week, this week is stored once the reports are sent
+    previous_totals = history_store.previous_week_totals(week, list(detailed_data.keys()))
+    for city, rows in table_data.items():
+        for row in rows:
+            previous_incassi, previous_presenze = previous_totals.get((city, row[0]), (None, None))
+            row.extend([trend(row[1], previous_incassi), trend(row[2], previous_presenze)])
+
+    home_city, home_cinema = registry.home
+    home_table_data = None
+    other_cities_data = [[c] + el for c in table_data if c != home_city for el in table_data[c]]
+
+    if home_city in table_data:
+        # Sort the table for the home city only
+        home_table_data = sorted(table_data[home_city], key=lambda x: (-x[2]))
+
+        # The home cinema, when the uploads have its rows, is compared with the competitors in the other cities
+        other_cities_data += [[home_city] + row for row in home_table_data if row[0] == home_cinema]
+
+    other_cities_data.sort(key=lambda x: (-x[3]))
+
+    cinema_tables = [(city, cinema) + detailed_data[(city, cinema)] for city, cinema in sort_cinema_pages(table_data, home_city)]
+
+    return ReportModel(home_city, home_table_data, other_cities_data, cinema_tables)
+
+def render_excel_report(model, full_name):
+    with pd.ExcelWriter(full_name, engine='xlsxwriter') as writer:
+        if model.home_table is not None:
+            home_df = pd.DataFrame(model.home_table, columns=COLUMN_AGGREGATED_LABELS + COLUMN_TREND_LABELS)
+            home_df.to_excel(writer, sheet_name=model.home_city[:31], index=False)
+
+            other_cities_df = pd.DataFrame(model.national_table, columns=['Città'] + COLUMN_AGGREGATED_LABELS + COLUMN_TREND_LABELS)
+            other_cities_df.to_excel(writer, sheet_name='Altre Città', index=False)
 
-async def process_xlsx(update: Update, context):
-    # Predefined data
-    cities = {'Roma':['Troisi', 'Barberini', 'Quattro Fontane', 'Farnese', 'Intrastevere', 'Nuovo Sacher', 'Greenwich'], 'Milano':['Beltrade'], 'Bologna':['Cinema Modernissimo'], 'Trento':['Roma']}
+        # Create detailed analysis for each cinema
+        for city, cinema, film_rows, total_row in model.cinema_tables:
+            cinema_table_data = [[twp.fill(row[0], 40)] + row[1:] for row in film_rows]
+            cinema_table_data.append(['Totale'] + total_row)
+            detailed_df = pd.DataFrame(cinema_table_data, columns=COLUMN_DETAILED_LABELS)
+
+            # Cinema Roma in Trento would otherwise overwrite the Roma sheet
+            sheet_name = cinema if cinema not in writer.sheets else f"{cinema} ({city})"[:31]
+            detailed_df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+def render_csv_report(model, full_name):
+    # One row per film and cinema, for spreadsheets and scripts
+    rows = [[city, cinema] + film_row for city, cinema, film_rows, _ in model.cinema_tables for film_row in film_rows]
+    csv_df = pd.DataFrame(rows, columns=['Città', 'Cinema'] + COLUMN_DETAILED_LABELS)
+    csv_df.to_csv(full_name, index=False)
+
+def latex_escape(value):
+    # Trend percentages and some film titles contain characters LaTeX treats as commands
+    if not isinstance(value, str):
+        return value
+    return re.sub(r'([%&#$_{}])', r'\\\1', value)
+
+class LatexPdfRenderer:
+    # Every page is a matplotlib figure with the table labels typeset by LaTeX
+    def __init__(self, full_name):
+        plt.rcParams['text.usetex'] = True
+        self.pdf = backend_pdf.PdfPages(full_name)
+
+    def add_table_page(self, title, col_labels, rows, font_size, scale, bold_last_row=False):
+        rows = [[latex_escape(value) for value in row] for row in rows]
+        if bold_last_row:
+            rows = rows[:-1] + [[rf'\textbf{{{rows[-1][0]}}}'] + rows[-1][1:]]
+
+        fig = plt.figure(dpi=100)
+        table = plt.table(cellText=rows, loc='center', colLabels=[rf'\textbf{{{latex_escape(label)}}}' for label in col_labels], cellLoc="center")
+        fig.suptitle(latex_escape(title), fontsize=10)
+        plt.axis('off')
+        table.auto_set_font_size(False)
+        table.set_fontsize(font_size)
+        table.scale(*scale)
+
+        for i in range(len(col_labels)):
+            table[0, i].set_facecolor(HEADER_COLOR)
+
+        self.pdf.savefig(fig)
+        plt.close(fig)
+
+    def close(self):
+        self.pdf.close()
+
+class DirectPdfRenderer:
+    # Draws the tables straight onto a reportlab canvas, with no figure or LaTeX run per page.
+    # Pages keep the size of the matplotlib figures and tables are scaled down to fit when needed
+    page_size = (6.4 * 72, 4.8 * 72)
+    padding = 2
+
+    def __init__(self, full_name):
+        self.canvas = pdf_canvas.Canvas(full_name, pagesize=self.page_size)
+
+    def add_table_page(self, title, col_labels, rows, font_size, scale, bold_last_row=False):
+        page_width, page_height = self.page_size
+        cells = [[str(value).split("\n") for value in row] for row in [col_labels] + rows]
+        bold_rows = {0, len(cells) - 1} if bold_last_row else {0}
+
+        # Size the columns and rows around their text
+        line_height = font_size * 1.2
+        col_widths = [0] * len(col_labels)
+        for r, row in enumerate(cells):
+            font = "Helvetica-Bold" if r in bold_rows else "Helvetica"
+            for c, lines in enumerate(row):
+                col_widths[c] = max([col_widths[c]] + [pdfmetrics.stringWidth(line, font, font_size) for line in lines])
+        col_widths = [(width + 2 * self.padding) * scale[0] for width in col_widths]
+        row_heights = [(max(len(lines) for lines in row) * line_height + 2 * self.padding) * scale[1] for row in cells]
+
+        # Like matplotlib's tables, narrow tables are stretched to the width of the axes
+        min_width = page_width * 0.775
+        if sum(col_widths) < min_width:
+            extra = (min_width - sum(col_widths)) / len(col_widths)
+            col_widths = [width + extra for width in col_widths]
+
+        table_width = sum(col_widths)
+        table_height = sum(row_heights)
+        fit = min(1, page_width * 0.9 / table_width, page_height * 0.8 / table_height)
+
+        self.canvas.setFont("Helvetica", 10)
+        self.canvas.drawCentredString(page_width / 2, page_height - 20, title)
+
+        self.canvas.saveState()
+        self.canvas.translate((page_width - table_width * fit) / 2, (page_height - 20 + table_height * fit) / 2)
+        self.canvas.scale(fit, fit)
+        self.canvas.setLineWidth(0.5)
+
+        y = 0
+        for r, row in enumerate(cells):
+            x = 0
+            y -= row_heights[r]
+            font = "Helvetica-Bold" if r in bold_rows else "Helvetica"
+            for c, lines in enumerate(row):
+                if r == 0:
+                    self.canvas.setFillColor(HEADER_COLOR)
+                    self.canvas.rect(x, y, col_widths[c], row_heights[r], stroke=1, fill=1)
+                    self.canvas.setFillColor("black")
+                else:
+                    self.canvas.rect(x, y, col_widths[c], row_heights[r], stroke=1, fill=0)
+
+                # Center the lines of the cell vertically and horizontally
+                self.canvas.setFont(font, font_size)
+                text_y = y + (row_heights[r] + (len(lines) - 2) * line_height) / 2 + font_size * 0.25
+                for line in lines:
+                    self.canvas.drawCentredString(x + col_widths[c] / 2, text_y, line)
+                    text_y -= line_height
+                x += col_widths[c]
+
+        self.canvas.restoreState()
+        self.canvas.showPage()
+
+    def close(self):
+        self.canvas.save()
+
+PDF_RENDERERS = {"latex": LatexPdfRenderer, "direct": DirectPdfRenderer}
+
+def build_pdf_pages(model):
+    # Returns the report pages in order as add_table_page arguments, so they can be rendered independently
+    pages = []
+
+    if model.home_table is not None:
+        pages.append((f"Totale Competitor {model.home_city}", COLUMN_AGGREGATED_LABELS + COLUMN_TREND_LABELS, model.home_table, 6, (1.2, 1.2)))
+
+    pages.append(("Totale Competitor Nazionali", ['Città'] + COLUMN_AGGREGATED_LABELS + COLUMN_TREND_LABELS, model.national_table, 6, (1.2, 1.2)))
+
+    # Create detailed analysis for each cinema
+    for city, cinema, film_rows, total_row in model.cinema_tables:
+        cinema_table_data = [[twp.fill(row[0], 40)] + row[1:] for row in film_rows]
+        cinema_table_data.append(['Totale'] + total_row)
+        pages.append((f"{cinema} ({city}) - Incassi settimanali", COLUMN_DETAILED_LABELS, cinema_table_data, 5, (1.2, 1.25), True))
+
+    return pages
+
+# Formats rendered in a single call on the render pool, the pdf is split into pages instead
+REPORT_RENDERERS = {"xlsx": render_excel_report, "csv": render_csv_report}
+REPORT_FORMATS = ["pdf"] + list(REPORT_RENDERERS)
+
+def render_pdf_pages(pages, full_name, renderer=None):
+    pdf = PDF_RENDERERS[renderer or PDF_RENDERER](full_name)
+    for page in pages:
+        pdf.add_table_page(*page)
+    pdf.close()
+
+def merge_pdf_fragments(fragment_names, full_name):
+    writer = pypdf.PdfWriter()
+    for fragment_name in fragment_names:
+        writer.append(fragment_name)
+    with open(full_name, 'wb') as file:
+        writer.write(file)
+
+class WorkspaceManager:
+    # Per-chat uploads kept in memory as parse futures, plus a directory for the chat's reports,
+    # so concurrent chats never see or delete each other's data
+    def __init__(self, root, ttl):
+        self.root = root
+        self.ttl = ttl
+        self.pending_uploads = {}
+        self.last_used = {}
+
+    def path(self, chat_id):
+        path = os.path.join(self.root, str(chat_id))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def add_upload(self, chat_id, file_name, future):
+        self.pending_uploads.setdefault(chat_id, []).append((file_name, future))
+        self.last_used[chat_id] = time.time()
+        return len(self.pending_uploads[chat_id])
+
+    def uploads(self, chat_id):
+        return list(self.pending_uploads.get(chat_id, []))
+
+    def take_uploads(self, chat_id):
+        # Hand the uploads over to a job, files sent afterwards go to the next analysis
+        self.last_used[chat_id] = time.time()
+        return self.pending_uploads.pop(chat_id, [])
+
+    def clear(self, chat_id):
+        self.pending_uploads.pop(chat_id, None)
+        self.last_used.pop(chat_id, None)
+        shutil.rmtree(os.path.join(self.root, str(chat_id)), ignore_errors=True)
+
+    def remove_expired(self, active_chats):
+        now = time.time()
+        for chat_id, last_used in list(self.last_used.items()):
+            if chat_id not in active_chats and now - last_used > self.ttl:
+                logger.info(f"Removing workspace of chat {chat_id}, idle for {int(now - last_used)}s")
+                self.clear(chat_id)
+
+workspaces = WorkspaceManager(WORKSPACES_DIR, WORKSPACE_TTL)
+
+class ReportJob:
+    # A queued /analizza request, from the files it snapshots to the document it produces
+    def __init__(self, job_id, chat_id, formats, uploads, week):
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.formats = formats
+        self.uploads = uploads
+        # Cinema week the uploads cover, the key of their totals in the history
+        self.week = week
+        self.full_names = []
+        self.status = "in coda"
+        self.completed = []
+        self.done = 0
+        self.total = 0
+        self.detail = None
+        self.progress = None
+
+    def set_status(self, status, total=0):
+        if self.status != "in coda":
+            self.completed.append(self.status + (f" ({self.done}/{self.total})" if self.total > 0 else ""))
+        self.status = status
+        self.done = 0
+        self.total = total
+        self.detail = None
+        if self.progress is not None:
+            self.progress.notify()
+
+    def advance(self, detail=None):
+        self.done += 1
+        self.detail = detail
+        if self.progress is not None:
+            self.progress.notify()
+
+    def remove_files(self):
+        # Only the job's own reports are removed, other jobs of the chat keep theirs
+        for full_name in self.full_names:
+            if os.path.isfile(full_name):
+                os.remove(full_name)
+
+class ProgressReporter:
+    # Keeps one Telegram message per job up to date from a background task. The job only wakes
+    # the task up, which edits the message with the latest state at most once every interval
+    # seconds, so rendering never waits on Telegram and bursts of pages cost a single edit
+    def __init__(self, bot, job, interval):
+        self.bot = bot
+        self.job = job
+        self.interval = interval
+        self.message_id = None
+        self.last_text = None
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def notify(self):
+        self.changed.set()
+
+    def text(self):
+        job = self.job
+        lines = ["Analisi completata" if job.status == "completata" else "Analisi in corso"]
+        lines += [f"✅ {stage}" for stage in job.completed]
+
+        if job.status != "completata":
+            line = f"⏳ {job.status}"
+            if job.total > 0:
+                filled = round(10 * job.done / job.total)
+                line += f" {job.done}/{job.total} [{'█' * filled}{'░' * (10 - filled)}]"
+            lines.append(line)
+            if job.detail:
+                lines.append(job.detail)
+
+        return "\n".join(lines)
+
+    async def run(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            await self.flush()
+            await asyncio.sleep(self.interval)
+
+    async def flush(self):
+        text = self.text()
+        if text == self.last_text:
+            return
+
+        try:
+            if self.message_id is None:
+                message = await self.bot.send_message(self.job.chat_id, text)
+                self.message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(text, chat_id=self.job.chat_id, message_id=self.message_id)
+            self.last_text = text
+        except TelegramError as e:
+            logger.warning(f"Could not update the progress of job {self.job.job_id}: {e}")
+
+    async def close(self):
+        # Stop the background task and show the final state right away
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.task
+        await self.flush()
+
+def get_render_pool():
+    global render_pool
+
+    if render_pool is None:
+        render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=load_modules, initargs=(RENDER_MODULES,))
+    return render_pool
+
+async def enqueue_report(update: Update, formats, week=None):
+    chat_id = update.message.chat_id
+
+    # Check the chat has sent some Excel files
+    if len(workspaces.uploads(chat_id)) == 0:
+        await update.message.reply_text("Non ho trovato file excel (.xlsx), fai l'upload dei file prima.")
+        return
 
-    column_aggregated_labels = [r'\textbf{Sala}', r'\textbf{Incassi totali}', r'\textbf{Presenze totali}', r'\textbf{Prezzo medio}']
-    column_detailed_labels = [r'\textbf{Film}', r'\textbf{Incassi}', r'\textbf{Presenze}', r'\textbf{Prezzo medio}']
+    if len([job for job in jobs.values() if job.chat_id == chat_id]) >= MAX_JOBS_PER_CHAT:
+        await update.message.reply_text("Hai già un'analisi in corso, aspetta che finisca prima di chiederne un'altra.")
+        return
 
-    print("Processing files sent...")
+    # The exports do not say which week they cover: the week is the one given with the command,
+    # otherwise the last week that has already ended
+    week = week or last_cinema_week(datetime.now())
 
-    # List Excel files in the current directory
-    results = [each for each in os.listdir(".") if each.endswith('.xlsx')]
+    job = ReportJob(next(job_ids), chat_id, formats, workspaces.take_uploads(chat_id), week)
+    jobs[job.job_id] = job
+    await job_queue.put(job)
 
-    if len(results) > 0:
-        dfs = []
+    await update.message.reply_text(f"Analisi della settimana {week} messa in coda (posizione {job_queue.qsize()}), ti mando il file appena è pronto.")
 
-        # Process each Excel file
-        for file in results:
-            full_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file)
+async def run_report_job(bot, job):
+    logger.info(f"Processing report job {job.job_id} for chat {job.chat_id}: {len(job.uploads)} files, formats {', '.join(job.formats)}")
+    job_start = time.perf_counter()
 
-            try:
-                df = pd.read_excel(full_path)
-            except ValueError as e:
-                clean_file(full_path)
-                df = pd.read_excel(full_path)
-
-            # Clean up DataFrame
-            df.columns = list(df.iloc[1])
-            df = df[2:-2].reset_index(drop=True)
-            dfs.append(df)
-
-        # Merge all DataFrames
-        df_merged = pd.concat(dfs, ignore_index=True, sort=False)
-        df_merged.fillna(0, inplace=True)
-        df_merged["Città"] = df_merged["Città"].str.title()
-        df_merged["Cinema"] = df_merged["Cinema"].str.title()
-        df_merged["Titolo Film"] = df_merged["Titolo Film"].str.title()
-        df_merged.drop_duplicates(inplace=True)
-
-        df_merged = df_merged.loc[df_merged['Città'].isin(list(cities.keys()))]
-       
-        # Filter cinema names and create a dictionary of DataFrames for each cinema
-        names = []
-        [names.extend(c) for c in cities.values()]
-        cinema_names = list(set(names).intersection(list(df_merged["Cinema"])))
-        df_cinemas = {name: filter_cinema(df_merged, name) for name in cinema_names}
-
-        # Extract relevant columns
-        columns_incasso = [col for col in df_merged.columns if "Incass" in col.split()[0]]
-        columns_presenze = [col for col in df_merged.columns if "Presenz" in col]
-
-        # Filter cities and create a dictionary of DataFrames for each city
-        filtered_cities = list(set(cities.keys()).intersection(list(df_merged["Città"])))
-        df_cinema_city = {city: df_merged.loc[df_merged['Città'] == city] for city in filtered_cities}
-
-        # Get current datetime for file naming
-        current_datetime = datetime.now()
-        formatted_date = current_datetime.strftime("%d_%m_%Y")
-        full_name = f'Analisi_{formatted_date}.pdf'
-
-        # Generate PDF file with analysis
-        with PdfPages(full_name) as pdf:
-            table_data = {}
-
-            to_remove = []
-
-            # Iterate over each city
-            for city in filtered_cities:
-                curr_df = df_cinema_city[city]
-                curr_keys = list(set(names).intersection(list(curr_df["Cinema"])))
-
-                if len(curr_keys) == 0:
-                    print(f"No matching cinema for {city}")
-                    to_remove.append(city)
-                    continue
+    job.progress = ProgressReporter(bot, job, PROGRESS_INTERVAL)
+    try:
+        n_rows = await build_reports(bot, job)
+    finally:
+        await job.progress.close()
+
+    metrics.record("job", time.perf_counter() - job_start, n_rows, files=len(job.uploads), formats=job.formats)
+
+async def build_reports(bot, job):
+    # Collect the Excel files parsed on the parse pool
+    job.set_status("lettura dei file", len(job.uploads))
+    for file_name, future in job.uploads:
+        future.add_done_callback(lambda _, file_name=file_name: job.advance(f"Letto {file_name}"))
+    buffer, failed = await parse_uploaded_files(job.uploads)
+
+    if len(failed) > 0:
+        await bot.send_message(job.chat_id, f"Non sono riuscito a leggere questi file, li salto: {', '.join(failed)}")
+    if len(failed) == len(job.uploads):
+        raise ValueError("None of the uploaded files could be parsed")
+
+    # Files holding only the header have nothing to aggregate
+    if buffer.n_rows == 0:
+        await bot.send_message(job.chat_id, "Nei file inviati non ho trovato nessuna riga di dati, non c'è niente da analizzare.")
+        job.set_status("completata")
+        return 0
+
+    # Get current datetime for file naming
+    current_datetime = datetime.now()
+    formatted_date = current_datetime.strftime("%d_%m_%Y")
+
+    # Aggregate once, every requested format is rendered from the same report model
+    job.set_status("analisi dei dati")
+    loop = asyncio.get_running_loop()
+    model, elapsed, peak_rss = await loop.run_in_executor(get_render_pool(), measured, build_report_model, buffer, job.week, competitors)
+    metrics.record("aggregate", elapsed, buffer.n_rows, peak_rss=peak_rss, cinemas=len(model.cinema_tables))
+
+    for report_format in job.formats:
+        full_name = os.path.join(workspaces.path(job.chat_id), f'Analisi_{formatted_date}_{job.job_id}.{report_format}')
+        job.full_names.append(full_name)
+
+        # Render the report on the render pool so the event loop stays free
+        start = time.perf_counter()
+        if report_format == "pdf":
+            pages = build_pdf_pages(model)
+            job.set_status("creazione del report pdf", len(pages))
+            await render_pdf_report(job, pages, full_name)
+            metrics.record("render_pdf", time.perf_counter() - start, n_bytes=os.path.getsize(full_name), pages=len(pages))
+        else:
+            job.set_status(f"creazione del report {report_format}")
+            _, elapsed, peak_rss = await loop.run_in_executor(get_render_pool(), measured, REPORT_RENDERERS[report_format], model, full_name)
+            metrics.record(f"render_{report_format}", elapsed, n_bytes=os.path.getsize(full_name), peak_rss=peak_rss)
+
+        # The report is read off the event loop and uploaded from memory
+        job.set_status(f"invio del report {report_format}")
+        start = time.perf_counter()
+        with io.BytesIO(await asyncio.to_thread(Path(full_name).read_bytes)) as document:
+            await bot.send_document(job.chat_id, document=document, filename=f'Analisi_{formatted_date}.{report_format}')
+        metrics.record("send_document", time.perf_counter() - start, n_bytes=os.path.getsize(full_name), format=report_format)
+
+    # Only a week whose reports went out is kept, a failed job leaves the history as it was
+    job.set_status("salvataggio dello storico")
+    await asyncio.to_thread(history_store.merge_week, job.week, model.cinema_tables)
+
+    job.set_status("completata")
+    return buffer.n_rows
+
+async def render_pdf_report(job, pages, full_name):
+    # Every page is rendered into its own PDF fragment by the render pool, then the fragments
+    # are merged in page order
+    loop = asyncio.get_running_loop()
+    pool = get_render_pool()
+
+    if not HAS_PYPDF:
+        # Without pypdf the fragments cannot be merged, render all the pages in one worker
+        await loop.run_in_executor(pool, render_pdf_pages, pages, full_name)
+        return
+
+    async def render_page(i, fragment_name):
+        _, elapsed, peak_rss = await loop.run_in_executor(pool, measured, render_pdf_pages, [pages[i]], fragment_name)
+        metrics.record("page", elapsed, len(pages[i][2]), peak_rss=peak_rss, title=pages[i][0])
+        return i
+
+    fragments_dir = tempfile.mkdtemp(dir=os.path.dirname(full_name))
+    try:
+        fragment_names = [os.path.join(fragments_dir, f"{i:04d}.pdf") for i in range(len(pages))]
+        for page_done in asyncio.as_completed([render_page(i, name) for i, name in enumerate(fragment_names)]):
+            i = await page_done
+            job.advance(f"Pagina completata: {pages[i][0]}")
+
+        _, elapsed, peak_rss = await loop.run_in_executor(pool, measured, merge_pdf_fragments, fragment_names, full_name)
+        metrics.record("merge_pdf", elapsed, n_bytes=os.path.getsize(full_name), peak_rss=peak_rss, pages=len(pages))
+    finally:
+        shutil.rmtree(fragments_dir, ignore_errors=True)
+
+async def report_worker(application: Application) -> None:
+    # Takes jobs off the queue one at a time, REPORT_WORKERS of these run side by side
+    global render_pool
+
+    while True:
+        job = await job_queue.get()
+
+        try:
+            await run_report_job(application.bot, job)
+        except Exception as e:
+            logger.error(f"Report job {job.job_id} for chat {job.chat_id} failed", exc_info=e)
+            if isinstance(e, BrokenProcessPool):
+                render_pool = None
+            await application.bot.send_message(
+                chat_id=job.chat_id, text="Sono incappato in un errore, l'autore del bot è stato notificato.\nHo cancellato tutti i dati fino ad'ora quindi puoi ricominciare a mandarmi file.", parse_mode=ParseMode.HTML
+            )
+        finally:
+            jobs.pop(job.job_id, None)
+            job_queue.task_done()
+            job.remove_files()
+
+async def remove_expired_workspaces() -> None:
+    while True:
+        await asyncio.sleep(WORKSPACE_CLEANUP_INTERVAL)
+        workspaces.remove_expired({job.chat_id for job in jobs.values()})
+
+async def prewarm_workers() -> None:
+    # One task per worker makes the pools start all their processes, which import their modules
+    # while the bot is already answering. numpy is needed here too, to merge the parsed files
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    for pool, n_workers in [(get_parse_pool(), PARSE_WORKERS), (get_render_pool(), RENDER_WORKERS)]:
+        await asyncio.gather(*[loop.run_in_executor(pool, os.getpid) for _ in range(n_workers)])
+    await asyncio.to_thread(load_modules, ["np"])
+    logger.info(f"Workers ready in {time.perf_counter() - start:.1f}s")
+
+async def start_report_workers(application: Application) -> None:
+    for _ in range(REPORT_WORKERS):
+        asyncio.create_task(report_worker(application))
+    asyncio.create_task(remove_expired_workspaces())
+    if PREWARM_WORKERS:
+        asyncio.create_task(prewarm_workers())
+    jokes.prefetch()
+    if METRICS_PORT:
+        await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
 
-                dati_per_cinema = {name: [round(sum([sum(df_cinemas[name][key]) for key in columns_incasso]), 2)] for name in curr_keys}
-                {dati_per_cinema[name].append(round(sum([sum(df_cinemas[name][key].apply(pd.to_numeric)) for key in columns_presenze]), 2)) for name in curr_keys}
-                {dati_per_cinema[key].append(round(value[0] / value[1], 2)) for key, value in dati_per_cinema.items()}
-
-                fig = plt.figure(dpi=100)
-                table_data[city] = [[key] + dati_per_cinema[key] for key in curr_keys]
-
-            # Remove cities with no matching cinema
-            [filtered_cities.remove(val) for val in to_remove]
-
-            rome_table_data = False
-
-            if "Roma" in list(table_data.keys()):
-                # Sort and create a table for Rome only
-                rome_table_data = copy.deepcopy(table_data["Roma"])
-                rome_table_data.sort(key=lambda x: (-x[2]))
-                table = plt.table(cellText=rome_table_data, loc='center', colLabels=column_aggregated_labels, cellLoc="center")
-                fig.suptitle(f"Totale Competitor Roma", fontsize=10)
-                plt.axis('off')
-                table.auto_set_font_size(False)
-                table.set_fontsize(6)
-                table.scale(1.2, 1.2)
-                for i in range(len(column_aggregated_labels)):
-                    table[0, i].set_facecolor('#add8e6')
-
-                pdf.savefig(fig)
-                plt.clf()
-
-                # Create a table for other cities
-                troisi_data = [val for val in rome_table_data if val[0] == "Troisi"]
-                troisi_data[0].insert(0, "Roma")
-                troisi_data = troisi_data[0]
-
-            other_cities_data = [[[c] + el for el in table_data[c]] for c in filtered_cities if c != "Roma"]
-            other_cities_data = [i for row in other_cities_data for i in row]
-            if rome_table_data:
-                other_cities_data.append(troisi_data)
-            other_cities_data.sort(key=lambda x: (-x[3]))
-
-            table = plt.table(cellText=other_cities_data, loc='center', colLabels=['\\textbf{Città}'] + column_aggregated_labels, cellLoc="center")
-            fig.suptitle(f"Totale Competitor Nazionali", fontsize=10)
-            plt.axis('off')
-            table.auto_set_font_size(False)
-            table.set_fontsize(6)
-            table.scale(1.2, 1.2)
-
-            for i in range(len(column_aggregated_labels) + 1):
-                table[0, i].set_facecolor('#add8e6')
-
-            pdf.savefig(fig)
-            plt.clf()
-
-            # Create detailed analysis for each cinema
-            if "Roma" in list(table_data.keys()):
-                sorted_cinema_names = [val[0] for val in table_data["Roma"]]
-                sorted_cinema_names.extend([table_data[key][0][0] for key in table_data.keys() if key != "Roma"])
-                if ("Roma" in list(df_cinemas.keys())):
-                    df_cinemas["Roma"] = df_cinemas["Roma"][df_cinemas["Roma"]["Città"] == "Trento"]
-            else:
-                sorted_cinema_names = [table_data[key][0][0] for key in table_data.keys()]
-
-            pbar = tg_tqdm(sorted_cinema_names, TOKEN, update.message.chat_id, total=len(sorted_cinema_names))
-
-            for cinema in pbar:
-                pbar.set_description(f"Sto processando il cinema {cinema}")
-
-                table_data = []
-                fig = plt.figure(dpi=100)
-                movies = df_cinemas[cinema]["Titolo Film"]
-                incassi_totali = 0
-                presenze_totali = 0
-
-                for i, movie in enumerate(movies):
-                    target_row = df_cinemas[cinema].loc[df_merged['Titolo Film'] == movie]
-                    incassi_film = target_row[columns_incasso].apply(pd.to_numeric).sum().sum()
-                    presenze_film = target_row[columns_presenze].apply(pd.to_numeric).sum().sum()
-                    costo_medio = round(incassi_film / presenze_film, 2)
-                    table_data.append([twp.fill(movie, 40), round(incassi_film, 2), presenze_film, costo_medio])
-                    incassi_totali += incassi_film
-                    presenze_totali += presenze_film
-
-                table_data.sort(key=lambda x: (-x[2]))
-                table_data.append([r'\textbf{Totale}', round(incassi_totali, 2), presenze_totali, round(incassi_totali / presenze_totali, 2)])
-                fig.suptitle(f"{cinema} ({df_cinemas[cinema]['Città'].iloc[0]}) - Incassi settimanali", fontsize=10)
-                plt.axis('off')
-                table = plt.table(cellText=table_data, loc='center', colLabels=column_detailed_labels, cellLoc="center")
-                table.auto_set_font_size(False)
-                table.set_fontsize(5)
-                table.scale(1.2, 1.25)
-
-                for i in range(len(column_detailed_labels)):
-                    table[0, i].set_facecolor('#add8e6')
-
-                pdf.savefig(fig)
-                plt.clf()
-
-            pdf.close()
-            plt.close()
-            await context.bot.send_document(update.message.chat_id, document=open(full_name, 'rb'))
-    else:
-        await update.message.reply_text("Non ho trovato file excel (.xlsx), fai l'upload dei file prima.")
+async def process_xlsx_to_excel(update: Update, context):
+    weeks = [parse_week_argument(arg) for arg in context.args]
+    await enqueue_report(update, ["xlsx"], next((week for week in weeks if week), None))
+
+async def process_xlsx(update: Update, context):
+    # /analizza takes the formats to produce and optionally a day of the week the files cover,
+    # e.g. "/analizza pdf xlsx csv 08/10/2026", and defaults to the pdf of the last week
+    week = None
+    formats = []
+    for arg in context.args:
+        if parse_week_argument(arg):
+            week = parse_week_argument(arg)
+        else:
+            formats.append(arg.lower().lstrip("."))
 
-    current_directory = os.getcwd()
+    formats = list(dict.fromkeys(formats)) or ["pdf"]
+    unknown = [report_format for report_format in formats if report_format not in REPORT_FORMATS]
 
-    # List all files in the current directory
-    files = os.listdir(current_directory)
+    if len(unknown) > 0:
+        await update.message.reply_text(f"Formato non supportato: {', '.join(unknown)}. Puoi scegliere tra {', '.join(REPORT_FORMATS)}.")
+        return
 
-    # Iterate through the files and remove each one, excluding those ending with ".py"
-    for file in files:
-        file_path = os.path.join(current_directory, file)
-        if os.path.isfile(file_path) and not file.endswith(".py"):
-            os.remove(file_path)
+    await enqueue_report(update, formats, week)
 
 
 # Replace 'YOUR_BOT_TOKEN' with your actual bot token
-with open('TOKEN', 'r') as file:
-    token = file.readline()
-    token.strip()
+token = None
+if os.path.isfile('TOKEN'):
+    with open('TOKEN', 'r') as file:
+        token = file.readline()
+        token.strip()
 
 TOKEN = token
 
@@ -404,6 +1442,8 @@ Trascina in questa chat i file excel che vuoi analizzare, puoi farlo un file all
 
 Una volta che avrai inviato tutti i file, puoi iniziare l'operazione di analisi con il comando /analizza
 La computazione dell'analisi prende dai 10 ai 30 secondi, una volta completata riceverai un pdf con i vari dati analizzati.
+Se vuoi l'analisi in altri formati indicali dopo il comando, ad esempio /analizza pdf xlsx csv, oppure usa /excel per avere solo il file excel.
+I file vengono confrontati con la settimana precedente: se non sono dell'ultima settimana conclusa (da giovedì a mercoledì) aggiungi un giorno della loro settimana, ad esempio /analizza 08/10/2026.
 
 Una volta terminata, il bot cancella i dati ricevuti quindi se vorrai un'altra analisi, dovrai dargli dei nuovi file excel.
 
@@ -412,39 +1452,170 @@ Se qualcosa non fosse chiaro scrivi a @NonenNone.
     await update.message.reply_text(help_message)
 
 async def handle_files(update: Update, context: CallbackContext) -> None:
+    start = time.perf_counter()
     file = await context.bot.get_file(update.message.document)
 
-    n_xlsx_files = len(list(Path(".").glob('*.xlsx')))
-
-    with open(f'{n_xlsx_files}.xlsx', 'wb') as buffer:
+    # Keep the upload in memory and start parsing it right away
+    with io.BytesIO() as buffer:
         await file.download_to_memory(buffer)
+        data = buffer.getvalue()
+    metrics.record("download", time.perf_counter() - start, n_bytes=len(data))
+
+    chat_id = update.message.chat_id
+    file_name = update.message.document.file_name or f"{len(workspaces.uploads(chat_id))}.xlsx"
+    n_xlsx_files = workspaces.add_upload(chat_id, file_name, start_parse(file_name, data))
 
-    await update.message.reply_text(f"Ho correttamente scaricato {n_xlsx_files + 1} file, grazie!")
+    await update.message.reply_text(f"Ho correttamente scaricato {n_xlsx_files} file, grazie!")
 
 
+def get_http_client():
+    global http_client
+
+    if http_client is None:
+        http_client = httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=httpx.Limits(max_connections=10, max_keepalive_connections=5))
+    return http_client
+
+async def close_http_client(application: Application) -> None:
+    global http_client
+
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+class JokeCache:
+    # A few jokes fetched ahead of time, so /mario usually answers without waiting on the joke API.
+    # Jokes older than the ttl are dropped and the cache is refilled in the background
+    def __init__(self, url, size, ttl):
+        self.url = url
+        self.size = size
+        self.ttl = ttl
+        self.jokes = collections.deque()
+        self.refill_task = None
+
+    async def fetch(self):
+        response = await get_http_client().get(self.url)
+        response.raise_for_status()
+        joke_data = response.json()
+        return time.monotonic(), f"{joke_data['setup']}\n\n{joke_data['punchline']}"
+
+    async def refill(self):
+        try:
+            results = await asyncio.gather(*[self.fetch() for _ in range(self.size - len(self.jokes))], return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.warning(f"Error prefetching joke: {result!r}")
+                else:
+                    self.jokes.append(result)
+        finally:
+            self.refill_task = None
+
+    def prefetch(self):
+        if self.refill_task is None:
+            self.refill_task = asyncio.create_task(self.refill())
+        return self.refill_task
+
+    async def get(self):
+        while len(self.jokes) > 0 and time.monotonic() - self.jokes[0][0] > self.ttl:
+            self.jokes.popleft()
+
+        joke = self.jokes.popleft()[1] if len(self.jokes) > 0 else (await self.fetch())[1]
+        self.prefetch()
+        return joke
+
+jokes = JokeCache(JOKE_API_URL, JOKE_CACHE_SIZE, JOKE_TTL)
+
 async def send_joke(update: Update, _) -> None:
-    api_url = 'https://official-joke-api.appspot.com/random_joke'
     try:
-        response = requests.get(api_url)
-        response.raise_for_status() 
-        joke_data = response.json()
-        await update.message.reply_text(f"{joke_data['setup']}\n\n{joke_data['punchline']}\n\nBadum tssssss....")
+        joke = await jokes.get()
+        await update.message.reply_text(f"{joke}\n\nBadum tssssss....")
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching joke: {e}")
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        logger.warning(f"Error fetching joke: {e!r}")
         await update.message.reply_text("No joke for you.")
 
 
 async def show_status(update: Update, _) -> None:
-    n_xlsx_files = len(list(Path(".").glob('*.xlsx')))
-    if n_xlsx_files == 0:
+    running = [job for job in jobs.values() if job.status != "in coda"]
+    n_queued = len(jobs) - len(running)
+
+    if len(jobs) == 0:
         help_message = "Il bot è operativo e non sta analizzando nessun file"
     else:
-        help_message = f"Il bot è operativo ma è occupato analizzando {n_xlsx_files} file"
+        help_message = f"Il bot è operativo: {len(running)} analisi in corso e {n_queued} in coda"
+
+    # Show the progress of the jobs belonging to this chat
+    for job in jobs.values():
+        if job.chat_id != update.message.chat_id:
+            continue
+
+        help_message += f"\nLa tua analisi è in fase di {job.status}"
+        if job.total > 0:
+            help_message += f" ({job.done}/{job.total})"
+
+    if parsed_cache.enabled:
+        help_message += f"\nFile già letti in precedenza: {parsed_cache.hits}, file nuovi: {parsed_cache.misses}"
+
+    await update.message.reply_text(help_message)
+
+
+async def edit_competitors(update: Update, context: CallbackContext) -> None:
+    if update.message.chat_id not in ADMIN_CHAT_IDS:
+        await update.message.reply_text("Non hai i permessi per modificare la lista dei cinema")
+        return
+
+    action = context.args[0].lower() if context.args else ""
+    if action not in ["aggiungi", "rimuovi", "casa"]:
+        help_message = f"Cinema di casa: {competitors.home[1]} ({competitors.home[0]})\nCinema monitorati:\n"
+        help_message += "\n".join(f"{city}: {', '.join(cinemas)}" for city, cinemas in competitors.cities.items())
+        help_message += "\n\nPer modificarli usa /competitor aggiungi Città, Cinema oppure /competitor rimuovi Città, Cinema"
+        help_message += "\nPer cambiare il cinema di casa usa /competitor casa Città, Cinema"
+        await update.message.reply_text(help_message)
+        return
+
+    # Names are title-cased like the columns of the uploaded files
+    city, _, cinema = " ".join(context.args[1:]).partition(",")
+    city, cinema = city.strip().title(), cinema.strip().title()
+    if not city or not cinema:
+        await update.message.reply_text(f"Scrivi la città e il cinema separati da una virgola, ad esempio /competitor {action} Roma, Troisi")
+        return
+
+    if action == "casa":
+        competitors.set_home(city, cinema)
+        help_message = f"{cinema} ({city}) è ora il cinema di casa"
+    elif action == "aggiungi":
+        changed = competitors.add(city, cinema)
+        help_message = f"{cinema} ({city}) aggiunto" if changed else f"{cinema} ({city}) è già monitorato"
+    else:
+        changed = competitors.remove(city, cinema)
+        help_message = f"{cinema} ({city}) rimosso" if changed else f"{cinema} ({city}) non è monitorato"
 
     await update.message.reply_text(help_message)
 
 
+async def show_metrics(update: Update, _) -> None:
+    if update.message.chat_id not in ADMIN_CHAT_IDS:
+        await update.message.reply_text("Non hai i permessi per vedere le metriche")
+        return
+
+    lines = metrics.summary()
+    if len(lines) == 0:
+        await update.message.reply_text("Nessuna metrica raccolta finora")
+        return
+    await update.message.reply_text("Tempi delle ultime esecuzioni per fase:\n" + "\n".join(lines))
+
+async def serve_metrics(reader, writer):
+    # Bare HTTP endpoint for Prometheus, every request gets the current metrics
+    try:
+        while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+            pass
+        body = metrics.prometheus().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
 async def handle_error(update: Update, context: CallbackContext) -> None:
 
     logger.error("Exception while handling an update:", exc_info=context.error)
@@ -455,14 +1626,7 @@ async def handle_error(update: Update, context: CallbackContext) -> None:
     tb_string = "".join(tb_list)
     logger.error(tb_string, exc_info=context.error)
 
-    current_directory = os.getcwd()
-    files = os.listdir(current_directory)
-
-    # Iterate through the files and remove each one, excluding those ending with ".py"
-    for file in files:
-        file_path = os.path.join(current_directory, file)
-        if os.path.isfile(file_path) and not file.endswith(".py"):
-            os.remove(file_path)
+    workspaces.clear(update.message.chat_id)
 
     # Finally, send the message
     await context.bot.send_message(
@@ -471,14 +1635,17 @@ async def handle_error(update: Update, context: CallbackContext) -> None:
 
 
 def main() -> None:
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_init(start_report_workers).post_shutdown(close_http_client).build()
 
     # Define command handlers
     application.add_handler(CommandHandler("start", show_start_message))
     application.add_handler(CommandHandler("aiuto", show_help_message))
     application.add_handler(CommandHandler("analizza", process_xlsx))
+    application.add_handler(CommandHandler("excel", process_xlsx_to_excel))
     application.add_handler(CommandHandler("status", show_status))
     application.add_handler(CommandHandler("mario", send_joke))
+    application.add_handler(CommandHandler("competitor", edit_competitors))
+    application.add_handler(CommandHandler("metrics", show_metrics))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_files))
     application.add_error_handler(handle_error)
 